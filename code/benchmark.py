@@ -0,0 +1,411 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Benchmark suite for the render-to-refresh pipeline: image decode, resize,
+# composition, text, packing, plane preparation, init/LUT sequences and the
+# full, fast and partial display paths, with SPI bytes/transfers per operation.
+#
+# usage: python3 benchmark.py [-n ROUNDS] [--backend sim|rpi|native] [-o results.json]
+#                             [--baseline base.json] [--save-baseline base.json]
+#                             [--compare rpi,native]
+#
+# Runs against the simulated panel at full speed by default. Exits with status 1
+# when an operation is slower than the baseline by more than --tolerance.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+import dither
+import local_epaper_fns
+from local_epaper_fns import EPD, NativeBackend, SimulatedPanel
+from render_cache import RenderCache
+from font_cache import FontManager
+from frame_store import FrameStore, write_store
+from multi_panel import MultiPanel
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_font(path, size):
+    # (font, True) for the requested face, (default font, False) when it is missing
+    try:
+        return ImageFont.truetype(path, size), True
+    except (IOError, OSError):
+        return ImageFont.load_default(), False
+
+
+## reference implementations (as shipped before the optimisations)
+def legacy_getbuffer(epd, image):
+    img = image.convert('1')
+    buf = bytearray(img.tobytes('raw'))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+def legacy_display_planes(epd, image):
+    Width = epd.width // 8
+    image1 = [0xFF] * int(epd.width * epd.height / 8)
+    for j in range(epd.height):
+        for i in range(Width):
+            image1[i + j * Width] = ~image[i + j * Width]
+    return image1
+
+
+def legacy_send_command(epd, command):
+    epd.backend.digital_write(epd.dc_pin, 0)
+    epd.backend.digital_write(epd.cs_pin, 0)
+    epd.backend.spi_writebyte([command])
+    epd.backend.digital_write(epd.cs_pin, 1)
+
+
+def legacy_send_data(epd, data):
+    epd.backend.digital_write(epd.dc_pin, 1)
+    epd.backend.digital_write(epd.cs_pin, 0)
+    epd.backend.spi_writebyte([data])
+    epd.backend.digital_write(epd.cs_pin, 1)
+
+
+def legacy_set_lut(epd, *luts):
+    for command, lut in zip(range(0x20, 0x25), luts):
+        legacy_send_command(epd, command)
+        for count in range(0, 42):
+            legacy_send_data(epd, lut[count])
+
+
+class Suite:
+    def __init__(self, epd, rounds):
+        self.epd = epd
+        self.rounds = rounds
+        self.results = {}
+
+    def run(self, name, fn, setup=None):
+        # best-of timing; SPI counters are for a single run of fn
+        backend = self.epd.backend
+        counted = hasattr(backend, 'bytes_sent')
+        best = None
+        for _ in range(self.rounds):
+            if setup is not None:
+                setup()
+            sent, transfers = (backend.bytes_sent, backend.transfers) if counted else (0, 0)
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        result = {'seconds': best}
+        if counted:
+            result['spi_bytes'] = backend.bytes_sent - sent
+            result['spi_transfers'] = backend.transfers - transfers
+        self.results[name] = result
+        return result
+
+
+def run_transfers(suite, names, frame_size):
+    # raw SPI writes per backend: a frame plane as bytearray and as bytes, and
+    # the five 42-byte LUT tables
+    plane = bytearray(frame_size)
+    plane_bytes = bytes(plane)
+    lut = bytes(42)
+    for name in names:
+        if name == 'sim':
+            backend = SimulatedPanel(time_scale=0)
+        elif name == 'native':
+            # not in BACKENDS until verified on hardware
+            backend = NativeBackend()
+        else:
+            backend = local_epaper_fns.get_backend(name)
+        backend.module_init()
+        backend.digital_write(backend.DC_PIN, 1)
+        suite.run('spi.%s.plane' % name, lambda b=backend: b.spi_writebyte2(plane))
+        suite.run('spi.%s.plane_bytes' % name, lambda b=backend: b.spi_writebyte2(plane_bytes))
+        suite.run('spi.%s.luts' % name, lambda b=backend: [b.spi_writebyte2(lut) for _ in range(5)])
+        backend.module_exit()
+
+
+INGEST_CODE = """
+import resource, sys
+from PIL import Image
+import local_epaper_fns
+path, how = sys.argv[1], sys.argv[2]
+if how == 'legacy':
+    Image.open(path).resize((360, 360), Image.LANCZOS).convert('L')
+elif how == 'draft':
+    local_epaper_fns.load_image(path, (360, 360))
+# VmHWM belongs to this process image; ru_maxrss can carry the parent's peak over exec
+try:
+    with open('/proc/self/status') as f:
+        print([line.split()[1] for line in f if line.startswith('VmHWM:')][0])
+except (IOError, OSError, IndexError):
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def run_ingest(suite, megapixels=12):
+    # a synthetic multi-megapixel photo taken to the display.py image size,
+    # full decode + LANCZOS vs load_image; peak RSS (kB) is measured in a
+    # fresh process per method, 'baseline' only imports the modules
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'photo.jpg')
+        noise = Image.effect_noise((width // 8, height // 8), 64).resize((width, height))
+        Image.merge('RGB', (noise, Image.linear_gradient('L').resize((width, height)), noise)).save(path, quality=90)
+        suite.run('ingest.legacy', lambda: Image.open(path).resize((360, 360), Image.LANCZOS).convert('L'))
+        suite.run('ingest.draft', lambda: local_epaper_fns.load_image(path, (360, 360)))
+        for how in ('baseline', 'legacy', 'draft'):
+            out = subprocess.run([sys.executable, '-c', INGEST_CODE, path, how], cwd=here,
+                                 check=True, capture_output=True, text=True).stdout
+            suite.results.setdefault('ingest.' + how, {'seconds': 0.0})['peak_rss_kb'] = int(out)
+        # the other IMAGE_EXTENSIONS formats, in the modes reduce() cannot take
+        grey = Image.linear_gradient('L').resize((2000, 1500))
+        colour = Image.merge('RGB', (grey, grey.transpose(Image.FLIP_LEFT_RIGHT), grey))
+        for name, image in (('gif', colour.convert('P', palette=Image.ADAPTIVE)), ('bmp', grey.convert('1')),
+                            ('png', grey.convert('I').point(lambda v: v * 256).convert('I;16'))):
+            path = os.path.join(tmp, 'image.' + name)
+            image.save(path)
+            result = local_epaper_fns.load_image(path, (360, 360))
+            assert result.mode == 'L' and result.size == (360, 360), (name, image.mode)
+            suite.run('ingest.' + name, lambda p=path: local_epaper_fns.load_image(p, (360, 360)))
+
+
+def run_suite(epd, rounds, image_path, font_path, legacy=False):
+    suite = Suite(epd, rounds)
+    width, height = epd.width, epd.height
+
+    ## render: the display.py layout
+    new_size = 360
+    display_text = 'casi horneado'
+    font, have_font = load_font(font_path, 48)
+    state = {}
+
+    def decode():
+        state['img'] = Image.open(image_path)
+        state['img'].load()
+
+    def resize():
+        state['resized'] = state['img'].resize((new_size, new_size), Image.LANCZOS)
+
+    def compose():
+        state['canvas'] = Image.new('1', (width, height), color=0)
+        state['canvas'].paste(state['resized'], ((width - new_size) // 2, (height - new_size) // 2))
+
+    def text():
+        draw = ImageDraw.Draw(state['canvas'])
+        _, _, w, h = draw.textbbox((0, 0), display_text, font=font)
+        draw.text(((width - w) / 2, 20), display_text, font=font, fill=255)
+
+    suite.run('render.decode', decode)
+    suite.run('render.resize', resize)
+    suite.run('render.compose', compose)
+    suite.run('render.text', text)
+    if have_font:
+        manager = FontManager()
+
+        def text_cached():
+            _, _, w, h = manager.text_bbox(display_text, font_path, 48)
+            manager.draw_text(state['canvas'], ((width - w) / 2, 20), display_text, font_path, 48)
+
+        suite.run('render.text_cached', text_cached)
+
+    ## pack and prepare
+    canvas = state['canvas']
+    out = bytearray(epd.frame_size)
+    suite.run('pack.getbuffer', lambda: epd.getbuffer(canvas))
+    suite.run('pack.getbuffer_out', lambda: epd.getbuffer(canvas, out))
+    portrait = canvas.resize((height, width))
+    suite.run('pack.getbuffer_portrait', lambda: epd.getbuffer(portrait, out))
+    frame = epd.getbuffer(canvas)
+
+    def display_planes():
+        epd._frame(frame)
+        frame.translate(local_epaper_fns.INVERT_TABLE)
+
+    suite.run('pack.display_planes', display_planes)
+
+    ## dithering a full-panel photo straight into the packed frame
+    photo = Image.open(image_path).convert('L').resize((width, height))
+    for method in dither.METHODS:
+        dither.pack(photo, method, out=out)     # builds the cached threshold map
+        suite.run('dither.' + method, lambda: dither.pack(photo, method, out=out))
+
+    ## cached render: a hit skips decode, resize, compose and packing
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = RenderCache(cache_dir)
+        key = cache.key(image_path, width=width, height=height, new_size=new_size)
+        cache.put(key, frame)
+        suite.run('render.cache_hit', lambda: cache.get(cache.key(image_path, width=width,
+                                                                  height=height, new_size=new_size)))
+
+    ## init and LUT sequences: cold (out of deep sleep), warm (same mode again)
+    ## and a partial <-> fast mode switch, which only uploads the LUT delta
+    suite.run('init.full_cold', epd.init, setup=epd.sleep)
+    suite.run('init.full', epd.init)
+    suite.run('init.fast_cold', epd.init_fast, setup=epd.sleep)
+    suite.run('init.partial_cold', epd.init_part, setup=epd.sleep)
+    suite.run('init.partial_to_fast', epd.init_fast, setup=epd.init_part)
+    luts = (epd.LUT_VCOM_7IN5_V2, epd.LUT_WW_7IN5_V2, epd.LUT_BW_7IN5_V2,
+            epd.LUT_WB_7IN5_V2, epd.LUT_BB_7IN5_V2)
+    suite.run('lut.SetLut', lambda: epd.SetLut(*luts), setup=epd._registers.clear)
+    suite.run('lut.By_MCU', lambda: epd.Epaper_LUT_By_MCU(epd.Lut_partial), setup=epd._registers.clear)
+
+    ## refresh paths
+    epd.init()
+    suite.run('display.full', lambda: epd.display(frame))
+    suite.run('display.clear', epd.Clear)
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_path = os.path.join(store_dir, 'bench.frames')
+        write_store(store_path, [('bench', '', frame)], epd.frame_size, width, height)
+        with FrameStore(store_path) as store:
+            suite.run('display.full_mapped', lambda: epd.display(store.frame(0)))
+    epd.init_fast()
+    suite.run('display.fast', lambda: epd.display(frame))
+
+    epd.init_part()
+    changed = canvas.copy()
+    ImageDraw.Draw(changed).rectangle((16, 16, 111, 63), fill=255)
+    changed = epd.getbuffer(changed)
+    suite.run('display.partial_window', lambda: epd.display_Partial(changed, 16, 16, 112, 64),
+              setup=lambda: epd.display(frame))
+    suite.run('display.auto_partial', lambda: epd.display_auto(changed),
+              setup=lambda: epd.display(frame))
+    suite.run('display.auto_unchanged', lambda: epd.display_auto(frame),
+              setup=lambda: epd.display(frame))
+
+    ## four simulated panels at 1/50 of the real refresh time: a MultiPanel
+    ## overlaps their busy periods, the serial loop does not
+    if isinstance(epd.backend, SimulatedPanel):
+        wall = MultiPanel([EPD(SimulatedPanel(time_scale=0.02)) for _ in range(4)])
+        wall.init()
+        frames = [frame] * 4
+        suite.run('multi.full_x4', lambda: wall.display(frames))
+        suite.run('multi.full_x4_serial', lambda: [e.display(frame) for e in wall.epds])
+        wall.close()
+
+    run_ingest(suite)
+
+    ## cold start of a fresh interpreter, as for a cron-driven update; the
+    ## import should cost little more than the bare interpreter
+    def python(code):
+        return lambda: subprocess.run([sys.executable, '-c', code], cwd=here, check=True)
+
+    suite.run('startup.python', python('pass'))
+    suite.run('startup.import', python('import local_epaper_fns'))
+    suite.run('startup.import_epd', python('import local_epaper_fns; local_epaper_fns.EPD()'))
+
+    if legacy:
+        suite.run('legacy.getbuffer', lambda: legacy_getbuffer(epd, canvas))
+        suite.run('legacy.display_planes', lambda: legacy_display_planes(epd, frame))
+        suite.run('legacy.SetLut', lambda: legacy_set_lut(epd, *luts))
+        epd._dc_state = None
+
+    return suite.results
+
+
+def compare(results, baseline, tolerance, floor):
+    # names of operations slower than baseline * (1 + tolerance), ignoring
+    # differences below the noise floor (seconds)
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        result['baseline_seconds'] = base['seconds']
+        if base['seconds']:
+            result['ratio'] = result['seconds'] / base['seconds']
+        if (result['seconds'] - base['seconds'] > floor
+                and result['seconds'] > base['seconds'] * (1 + tolerance)):
+            regressions.append(name)
+    return regressions
+
+
+def print_table(results, regressions, stream):
+    for name, result in sorted(results.items()):
+        line = "%-26s %9.3f ms" % (name, result['seconds'] * 1000)
+        if 'spi_bytes' in result:
+            line += " %8d B %5d xfers" % (result['spi_bytes'], result['spi_transfers'])
+        if 'peak_rss_kb' in result:
+            line += "  peak %6d kB" % result['peak_rss_kb']
+        if 'ratio' in result:
+            line += "   x%.2f vs baseline" % result['ratio']
+        if name in regressions:
+            line += "   REGRESSION"
+        print(line, file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="e-paper pipeline benchmarks")
+    parser.add_argument('-n', '--rounds', type=int, default=5)
+    parser.add_argument('--backend', default='sim',
+                        help="sim (default, no hardware), rpi or native (refreshes the panel)")
+    parser.add_argument('--image', default=os.path.join(here, 'img', 'image.jpg'))
+    parser.add_argument('--font', default='Font.ttc')
+    parser.add_argument('--compare', default='',
+                        help="comma separated backends to time raw SPI writes on, e.g. rpi,native")
+    parser.add_argument('--legacy', action='store_true',
+                        help="also time the pre-optimisation implementations")
+    parser.add_argument('-o', '--output', help="write JSON results here instead of stdout")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--save-baseline', help="write these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown vs baseline (default 0.25 = 25%%)")
+    parser.add_argument('--floor-ms', type=float, default=0.5,
+                        help="ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    if args.backend == 'sim':
+        epd = EPD(SimulatedPanel(time_scale=0))
+    elif args.backend == 'native':
+        epd = EPD(NativeBackend())
+    else:
+        epd = EPD(args.backend)
+
+    results = run_suite(epd, args.rounds, args.image, args.font, args.legacy)
+    if args.compare:
+        transfers = Suite(epd, args.rounds)
+        run_transfers(transfers, args.compare.split(','), epd.frame_size)
+        results.update(transfers.results)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance, args.floor_ms / 1000.0)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'node': platform.node(),
+            'backend': args.backend,
+            'rounds': args.rounds,
+        },
+        'results': results,
+        'regressions': regressions,
+    }
+    print_table(results, regressions, sys.stderr)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
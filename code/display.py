@@ -3,62 +3,90 @@
 
 display_image = 'image.jpg'
 
-from local_epaper_fns import *
-logging.basicConfig(level=logging.DEBUG)
+import logging
+import time
 
-try:
+from PIL import Image
 
-## initiate logs
-    logging.info("e-paper log")
-## define function
-    epd = EPD()
-    logging.info("init and Clear")
-    epd.init_part() #epd.init_fast() #epd.init()
-    epd.Clear()
-## userinputs
-    new_size = 360
-    frame_width = epd.width
-    frame_height = epd.height
+from local_epaper_fns import EPD, load_image, module_exit
+from render_cache import RenderCache
+from font_cache import fonts
+from dither import dither
+
+## layout: centered square image with a title above it
+LAYOUT = {
+    'new_size': 360,
+    'display_text': 'casi horneado',
+    'font': 'Font.ttc',         # the fonts are default right now
+    'font_size': 48,
+    'dither_method': 'floyd-steinberg',    # see dither.METHODS, 'blue-noise' for smoother photos
+}
+
+def compose_frame(path, frame_width, frame_height, new_size, display_text, font, font_size,
+                  dither_method='floyd-steinberg'):
     x_offset = (frame_width - new_size) // 2
     y_offset = (frame_height - new_size) // 2
-    display_text = 'casi horneado'
 
+## decode the file at (about) the target size, in grey
+    resized_image = load_image(path, (new_size, new_size))
+    resized_image = dither(resized_image, dither_method)
 
-    img = Image.open(os.path.join(display_image))
-## resize file
-    resized_image = img.resize((new_size, new_size), Image.LANCZOS) #.save(os.path.join('resized.jpg')
-
-## Create a new 800x480 image
+## Create a new image of the panel size
     new_image = Image.new('1', (frame_width, frame_height), color=0)
 
 ## Paste the smaller image into the center of the new image
     new_image.paste(resized_image, (x_offset, y_offset))
 
-## the fonts are default right now
-    font48 = ImageFont.truetype('Font.ttc', 48)
-    
-    draw = ImageDraw.Draw(new_image)
-## add (centered) text
-    _, _, w, h = draw.textbbox((0, 0), display_text, font = font48)
-    draw.text(((frame_width-w)/2, 20), display_text, font = font48, fill = 255)
-## display image
-    epd.display(epd.getbuffer(new_image))
-    time.sleep(2)
+## add (centered) text, glyphs come from the shared font cache
+    _, _, w, h = fonts.text_bbox(display_text, font, font_size)
+    fonts.draw_text(new_image, ((frame_width-w)/2, 20), display_text, font, font_size, fill = 255)
+    return new_image
+
+def render_frame(epd, path, cache=None, layout=LAYOUT):
+    # packed frame for path, from the render cache when the source and layout
+    # are unchanged
+    if cache is not None:
+        key = cache.key(path, width=epd.width, height=epd.height, **layout)
+        frame = cache.get(key)
+        if frame is not None and len(frame) == epd.frame_size:
+            return frame
+    frame = epd.getbuffer(compose_frame(path, epd.width, epd.height, **layout))
+    if cache is not None:
+        cache.put(key, frame)
+    return frame
 
-    logging.info("Clear...")
-    epd.init()
-    epd.Clear()
-    epd.init()
-    epd.Clear()
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+
+    try:
+
+## initiate logs
+        logging.info("e-paper log")
+## define function
+        epd = EPD()
+        logging.info("init and Clear")
+        epd.init_part() #epd.init_fast() #epd.init()
+        epd.Clear()
+
+## render (or reuse) the frame
+        frame = render_frame(epd, display_image, RenderCache())
+## display image
+        epd.display(frame)
+        time.sleep(2)
 
-    logging.info("Goto Sleep...")
-    epd.sleep()
+        logging.info("Clear...")
+        epd.init()
+        epd.Clear()
+        epd.init()
+        epd.Clear()
 
-except IOError as e:
-    logging.info(e)
+        logging.info("Goto Sleep...")
+        epd.sleep()
 
-except KeyboardInterrupt:
-    logging.info("ctrl + c:")
-    module_exit(cleanup=True)
-    exit()
+    except IOError as e:
+        logging.info(e)
 
+    except KeyboardInterrupt:
+        logging.info("ctrl + c:")
+        module_exit(cleanup=True)
+        exit()
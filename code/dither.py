@@ -0,0 +1,152 @@
+# Dithering of photos and other greyscale content to the 1bpp panel format.
+#
+# Ordered dithering compares the image with a tiled threshold map in one
+# ImageChops pass plus one point() lookup, so it runs entirely in PIL's C code
+# (no per-pixel Python). Error diffusion uses PIL's built-in Floyd-Steinberg.
+# Methods, roughly from fastest to best looking on photos:
+#
+#   threshold        plain 50% cut, for line art and text
+#   bayer            ordered, Bayer matrix (size 2, 4, 8 or 16), regular cross-hatch
+#   blue-noise       ordered, void-and-cluster matrix, no visible pattern
+#   floyd-steinberg  error diffusion, sharpest detail but can worm on flat areas
+#
+# Threshold matrices and the tiled threshold maps are built once per size and
+# cached. pack() writes the result straight into the packed frame layout used
+# by EPD (1 = black, MSB first).
+#
+#     frame = dither.pack(photo, 'blue-noise')
+#     epd.display(frame)
+
+import functools
+import math
+import random
+
+from PIL import Image, ImageChops
+
+METHODS = ('threshold', 'bayer', 'blue-noise', 'floyd-steinberg')
+
+# pixels where the threshold map is above the grey level go black
+_BLACK_WHERE_SET = [255] + [0] * 255
+
+
+@functools.lru_cache(maxsize=None)
+def bayer_matrix(size):
+    # index matrix 0..size*size-1 as a tuple of rows
+    if size < 2 or size & (size - 1):
+        raise ValueError("Bayer matrix size must be a power of two, got %d" % size)
+    if size == 2:
+        return ((0, 2), (3, 1))
+    half = bayer_matrix(size // 2)
+    rows = []
+    for offset in ((0, 2), (3, 1)):
+        for row in half:
+            rows.append(tuple(4 * v + offset[0] for v in row) + tuple(4 * v + offset[1] for v in row))
+    return tuple(rows)
+
+
+@functools.lru_cache(maxsize=None)
+def blue_noise_matrix(size=16, sigma=1.5, seed=0):
+    # Ulichney's void-and-cluster: rank every cell by repeatedly removing the
+    # tightest cluster / filling the largest void of a toroidal binary pattern.
+    # The Gaussian energy is kept up to date incrementally, O(size^4) in total.
+    n = size * size
+    kernel = []
+    for dy in range(size):
+        for dx in range(size):
+            wy = min(dy, size - dy)
+            wx = min(dx, size - dx)
+            kernel.append(math.exp(-(wx * wx + wy * wy) / (2.0 * sigma * sigma)))
+    offsets = [[((y2 - y1) % size) * size + (x2 - x1) % size
+                for y2 in range(size) for x2 in range(size)]
+               for y1 in range(size) for x1 in range(size)]
+
+    def update(energy, p, sign):
+        for i, o in enumerate(offsets[p]):
+            energy[i] += sign * kernel[o]
+
+    def tightest_cluster(pattern, energy):
+        return max((i for i in range(n) if pattern[i]), key=energy.__getitem__)
+
+    def largest_void(pattern, energy):
+        return min((i for i in range(n) if not pattern[i]), key=energy.__getitem__)
+
+    # initial pattern: ~10% random points, relaxed until stable
+    rng = random.Random(seed)
+    pattern = [False] * n
+    energy = [0.0] * n
+    for p in rng.sample(range(n), max(1, n // 10)):
+        pattern[p] = True
+        update(energy, p, 1)
+    while True:
+        cluster = tightest_cluster(pattern, energy)
+        pattern[cluster] = False
+        update(energy, cluster, -1)
+        void = largest_void(pattern, energy)
+        pattern[void] = True
+        update(energy, void, 1)
+        if void == cluster:
+            break
+
+    ranks = [0] * n
+    ones = sum(pattern)
+    # phase 1: remove the initial points, tightest cluster first
+    work, work_energy = pattern[:], energy[:]
+    for rank in range(ones - 1, -1, -1):
+        cluster = tightest_cluster(work, work_energy)
+        work[cluster] = False
+        update(work_energy, cluster, -1)
+        ranks[cluster] = rank
+    # phase 2: fill the rest, largest void first
+    for rank in range(ones, n):
+        void = largest_void(pattern, energy)
+        pattern[void] = True
+        update(energy, void, 1)
+        ranks[void] = rank
+    return tuple(tuple(ranks[y * size:(y + 1) * size]) for y in range(size))
+
+
+def _matrix(method, size):
+    if method == 'bayer':
+        return bayer_matrix(size or 8)
+    return blue_noise_matrix(size or 16)
+
+
+@functools.lru_cache(maxsize=8)
+def threshold_map(method, size, width, height):
+    # 'L' image of the matrix tiled over width x height, levels 1..255, so that
+    # grey 0 is always black and grey 255 always white
+    matrix = _matrix(method, size)
+    n = len(matrix)
+    cells = n * n
+    rows = []
+    for row in matrix:
+        tile = bytes(1 + v * 255 // cells for v in row)
+        rows.append((tile * (width // n + 1))[:width])
+    data = b''.join(rows[y % n] for y in range(height))
+    return Image.frombytes('L', (width, height), data)
+
+
+def dither(image, method='bayer', size=None):
+    # mode '1' image of the same size
+    if method not in METHODS:
+        raise ValueError("Unknown dither method %r, expected one of %s" % (method, ', '.join(METHODS)))
+    if image.mode == '1':
+        return image
+    if method == 'floyd-steinberg':
+        return image.convert('1')
+    grey = image if image.mode == 'L' else image.convert('L')
+    if method == 'threshold':
+        return grey.convert('1', dither=Image.NONE)
+    thresholds = threshold_map(method, size, grey.width, grey.height)
+    return ImageChops.subtract(thresholds, grey).point(_BLACK_WHERE_SET, '1')
+
+
+def pack(image, method='bayer', size=None, out=None):
+    # dithered image packed MSB first with 1 = black, the EPD frame layout
+    packed = dither(image, method, size).tobytes('raw', '1;I')
+    if out is None:
+        return bytearray(packed)
+    if len(out) != len(packed):
+        raise ValueError("Output buffer must be %d bytes, got %d" % (len(packed), len(out)))
+    out[:] = packed
+    return out
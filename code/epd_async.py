@@ -0,0 +1,106 @@
+# asyncio facade for EPD.
+#
+# The blocking driver calls run on one dedicated worker thread, so SPI transfers
+# and the seconds-long BUSY wait (an edge wait, see EPD.ReadBusy) never block
+# the event loop. Calls are serialised in arrival order. Display calls that are
+# still waiting for their turn are coalesced: a newer frame replaces the queued
+# one and every waiting caller gets the result of the refresh that went out.
+#
+#     aepd = AsyncEPD(EPD())
+#     await aepd.init_async('partial')
+#     await aepd.display_auto_async(frame)
+
+import asyncio
+import concurrent.futures
+import functools
+
+
+class AsyncEPD:
+    def __init__(self, epd):
+        self.epd = epd
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='epd')
+        self._lock = None
+        # method name -> {'args', 'future', 'waiters'} for a queued, not yet started call
+        self._queued = {}
+
+    def __getattr__(self, name):
+        # width, height, getbuffer(), ... come straight from the EPD
+        return getattr(self.epd, name)
+
+    async def _run(self, fn, *args):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _coalesced(self, name, *args):
+        queued = self._queued.get(name)
+        if queued is not None:
+            queued['args'] = args
+            queued['waiters'] += 1
+            try:
+                return await asyncio.shield(queued['future'])
+            finally:
+                queued['waiters'] -= 1
+
+        future = asyncio.get_running_loop().create_future()
+        queued = self._queued[name] = {'args': args, 'future': future, 'waiters': 0}
+        try:
+            await self._start(name, queued)
+        except asyncio.CancelledError:
+            if self._queued.get(name) is queued:
+                # cancelled before its turn: the callers that merged into this
+                # call still get the refresh, from a task that takes our place
+                if queued['waiters']:
+                    asyncio.ensure_future(self._start(name, queued))
+                else:
+                    del self._queued[name]
+                    future.cancel()
+            raise
+        return await asyncio.shield(future)
+
+    async def _start(self, name, queued):
+        # wait for the driver, then run the queued call with the newest arguments;
+        # the outcome goes to queued['future'] even if this task is cancelled meanwhile
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # from here on newer calls queue behind this one instead of replacing it
+            del self._queued[name]
+            loop = asyncio.get_running_loop()
+            work = loop.run_in_executor(self._executor, getattr(self.epd, name), *queued['args'])
+            work.add_done_callback(functools.partial(self._settle, queued['future']))
+            await asyncio.wait([work])
+
+    @staticmethod
+    def _settle(future, work):
+        if future.done():
+            return
+        if work.exception() is not None:
+            future.set_exception(work.exception())
+            future.exception()     # callers still waiting re-raise it
+        else:
+            future.set_result(work.result())
+
+    async def display_async(self, image):
+        return await self._coalesced('display', image)
+
+    async def display_auto_async(self, image, threshold=None):
+        return await self._coalesced('display_auto', image, threshold)
+
+    async def display_Partial_async(self, image, Xstart, Ystart, Xend, Yend):
+        return await self._run(self.epd.display_Partial, image, Xstart, Ystart, Xend, Yend)
+
+    async def Clear_async(self):
+        return await self._run(self.epd.Clear)
+
+    async def init_async(self, mode='full'):
+        init = {'full': self.epd.init, 'fast': self.epd.init_fast, 'partial': self.epd.init_part}[mode]
+        return await self._run(init)
+
+    async def sleep_async(self):
+        return await self._run(self.epd.sleep)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
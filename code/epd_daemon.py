@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Resident display daemon. It owns the EPD, keeps the panel initialised between
+# updates and only re-initialises (reset + LUT upload) when the requested mode
+# differs from the current one.
+#
+# usage: python3 epd_daemon.py serve [--socket PATH] [--backend sim|rpi]
+#                                    [--idle-off SECONDS] [--idle-sleep SECONDS]
+#        python3 epd_daemon.py show IMAGE [--mode auto|full|fast|partial]
+#        python3 epd_daemon.py clear|sleep|status
+#
+# Protocol, one request per connection on a Unix stream socket: a JSON header
+# line, then `length` bytes of packed frame for the "frame" op. The daemon
+# answers with one JSON line as soon as the request is queued; the refresh
+# itself happens on the daemon's worker thread.
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from local_epaper_fns import EPD
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.environ.get('EPAPER_SOCKET', '/tmp/epaper.sock')
+
+# requested mode -> LUT mode the panel has to be initialised in
+LUT_MODES = {
+    'full': 'full',
+    'fast': 'fast',
+    'partial': 'partial',
+    'auto': 'partial',
+}
+
+
+class PanelDaemon:
+    def __init__(self, epd, cache=None):
+        self.epd = epd
+        self.cache = cache
+        self.refreshes = 0
+        self.last_error = None
+
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._worker = threading.Thread(target=self._run, name='epd-worker', daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._worker.join(timeout)
+
+    def submit(self, job):
+        with self._cond:
+            if job['op'] in ('frame', 'render'):
+                # a newer frame supersedes any frame still waiting
+                self._jobs = [j for j in self._jobs if j['op'] not in ('frame', 'render')]
+            self._jobs.append(job)
+            self._cond.notify()
+            return len(self._jobs)
+
+    def status(self):
+        with self._cond:
+            pending = len(self._jobs)
+        return {
+            # the EPD may have powered down on its own (idle policy)
+            'awake': self.epd.awake,
+            'powered': self.epd.powered,
+            'mode': self.epd.mode,
+            'refreshes': self.refreshes,
+            'pending': pending,
+            'last_error': self.last_error,
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._stopping:
+                    self._cond.wait()
+                if not self._jobs:
+                    break
+                job = self._jobs.pop(0)
+            try:
+                self._apply(job)
+                self.last_error = None
+            except Exception as e:
+                logger.exception("display job %s failed", job['op'])
+                self.last_error = str(e)
+        if self.epd.awake:
+            self.epd.sleep()
+
+    def _ensure_mode(self, mode):
+        # the panel state lives in the EPD, which may also have slept on its own
+        if self.epd.awake and self.epd.mode == mode:
+            return
+        logger.info("panel init: %s -> %s", self.epd.mode, mode)
+        if mode == 'full':
+            self.epd.init()
+        elif mode == 'fast':
+            self.epd.init_fast()
+        else:
+            self.epd.init_part()
+
+    def _apply(self, job):
+        op = job['op']
+        if op in ('frame', 'render'):
+            mode = job.get('mode', 'auto')
+            if op == 'render':
+                from display import render_frame
+                frame = render_frame(self.epd, job['image'], self.cache)
+            else:
+                frame = job['frame']
+            self._ensure_mode(LUT_MODES[mode])
+            if mode == 'auto':
+                if self.epd.display_auto(frame) is not None:
+                    self.refreshes += 1
+            else:
+                self.epd.display(frame)
+                self.refreshes += 1
+        elif op == 'clear':
+            self._ensure_mode(self.epd.mode or 'full')
+            self.epd.Clear()
+            self.refreshes += 1
+        elif op == 'sleep':
+            # deep sleep loses the controller RAM, EPD.sleep makes the next frame a full one
+            if self.epd.awake:
+                self.epd.sleep()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.daemon
+        try:
+            header = json.loads(self.rfile.readline())
+            op = header.get('op')
+            if op == 'status':
+                reply = dict(daemon.status(), ok=True)
+            elif op == 'frame':
+                self._check_mode(header)
+                length = int(header['length'])
+                if length != daemon.epd.frame_size:
+                    raise ValueError("frame must be %d bytes" % daemon.epd.frame_size)
+                header['frame'] = self.rfile.read(length)
+                if len(header['frame']) != length:
+                    raise ValueError("short frame")
+                reply = {'ok': True, 'queued': daemon.submit(header)}
+            elif op == 'render':
+                self._check_mode(header)
+                if not header.get('image'):
+                    raise ValueError("render needs an image path")
+                reply = {'ok': True, 'queued': daemon.submit(header)}
+            elif op in ('clear', 'sleep'):
+                reply = {'ok': True, 'queued': daemon.submit(header)}
+            else:
+                raise ValueError("unknown op %r" % op)
+        except (ValueError, KeyError) as e:
+            reply = {'ok': False, 'error': str(e)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+    @staticmethod
+    def _check_mode(header):
+        if header.get('mode', 'auto') not in LUT_MODES:
+            raise ValueError("unknown mode %r" % header['mode'])
+
+
+class _Server(socketserver.UnixStreamServer):
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, _Handler)
+
+
+def serve(socket_path=DEFAULT_SOCKET, epd=None, cache=None):
+    daemon = PanelDaemon(epd or EPD(), cache)
+    daemon.start()
+    server = _Server(socket_path, daemon)
+
+    def shutdown(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    logger.info("listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        daemon.stop()
+
+
+## client side
+def request(header, payload=None, socket_path=DEFAULT_SOCKET, timeout=10.0):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(header).encode('utf-8') + b'\n')
+        if payload is not None:
+            sock.sendall(payload)
+        reply = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    return json.loads(reply)
+
+
+def send_frame(frame, mode='auto', socket_path=DEFAULT_SOCKET):
+    frame = memoryview(frame).cast('B')
+    return request({'op': 'frame', 'mode': mode, 'length': len(frame)}, frame, socket_path)
+
+
+def send_image(path, mode='auto', socket_path=DEFAULT_SOCKET):
+    # the daemon renders the image with the display.py layout
+    return request({'op': 'render', 'mode': mode, 'image': os.path.abspath(path)},
+                   socket_path=socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="e-paper display daemon")
+    parser.add_argument('command', choices=['serve', 'show', 'clear', 'sleep', 'status'])
+    parser.add_argument('image', nargs='?')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--mode', default='auto', choices=sorted(LUT_MODES))
+    parser.add_argument('--backend', default=None, help="sim or rpi (serve only)")
+    parser.add_argument('--idle-off', type=float, default=None,
+                        help="power the panel off after this many idle seconds (serve only)")
+    parser.add_argument('--idle-sleep', type=float, default=None,
+                        help="deep sleep after this many idle seconds (serve only)")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        logging.basicConfig(level=logging.INFO)
+        from render_cache import RenderCache
+        epd = EPD(args.backend, idle_power_off=args.idle_off, idle_sleep=args.idle_sleep)
+        serve(args.socket, epd, RenderCache())
+        return
+    if args.command == 'show':
+        if not args.image:
+            parser.error("show needs an IMAGE")
+        reply = send_image(args.image, args.mode, args.socket)
+    else:
+        reply = request({'op': args.command}, socket_path=args.socket)
+    print(json.dumps(reply))
+    sys.exit(0 if reply.get('ok') else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# Font and glyph cache for 1-bit text rendering.
+#
+# Each (face, size) is loaded once and each character is rasterised once into a
+# 1-bit mask with its metrics. Strings are then drawn by pasting the cached
+# glyphs, and measured without going through ImageDraw.textbbox. Pair kerning
+# is applied as in PIL's basic layout; complex shaping (libraqm) is not, which
+# is fine for labels, clocks and counters.
+#
+# Glyphs are placed the way PIL's FreeType renderer places them on a '1' image:
+# pen positions in 1/64 pixel, the fractional part of the text position applied
+# to the pen, and the line offset by the difference between the glyph boxes and
+# the actual bitmaps. That offset depends on the whole line, so each glyph also
+# records where PIL puts its ink inside a line; see _rasterize. Checked against
+# ImageDraw.text and textbbox on '1' images; a line that starts with a glyph
+# lying wholly below the baseline, such as '_', can still be a pixel off.
+
+import math
+import threading
+
+from PIL import Image, ImageDraw, ImageFont
+
+# glyph the vertical in-line positions are measured against
+REFERENCE = 'H'
+
+
+def _pixel(value):
+    # 26.6 fixed point to pixels, rounding as FreeType's PIXEL() does
+    return (value + 32) >> 6
+
+
+def _round(value):
+    # C round(): halves away from zero
+    return math.floor(value + 0.5) if value >= 0 else math.ceil(value - 0.5)
+
+
+def _render(font, text):
+    # text drawn as on a '1' image with a margin all round, and that margin
+    margin = 2 * int(font.size)
+    left, top, right, bottom = font.getbbox(text, '1')
+    image = Image.new('1', (right - left + 2 * margin, bottom + 2 * margin), 0)
+    ImageDraw.Draw(image).text((margin, margin), text, font=font, fill=255)
+    return image, margin
+
+
+class Glyph:
+    # left..bottom and advance: font.getbbox/getlength in 1-bit mode. mask: the
+    # inked part of the glyph. In a line PIL puts that ink ink_x from the pen and
+    # ink_y below the reference glyph's ink; overhang (<= 0) is how far the
+    # bitmap reaches left of the pen and rise how far its top is above the
+    # reference's ink, which is what shifts a whole line.
+    __slots__ = ('mask', 'left', 'top', 'right', 'bottom', 'advance', 'ink_x', 'ink_y', 'rise', 'overhang')
+
+    def __init__(self, mask, left, top, right, bottom, advance, ink_x=0, ink_y=0, rise=0, overhang=0):
+        self.mask = mask
+        self.left = left
+        self.top = top
+        self.right = right
+        self.bottom = bottom
+        self.advance = advance
+        self.ink_x = ink_x
+        self.ink_y = ink_y
+        self.rise = rise
+        self.overhang = overhang
+
+
+class FontManager:
+    def __init__(self):
+        self._fonts = {}
+        self._glyphs = {}
+        self._kerning = {}
+        self._lock = threading.Lock()
+
+    def font(self, face, size):
+        key = (face, size)
+        font = self._fonts.get(key)
+        if font is None:
+            font = ImageFont.truetype(face, size)
+            with self._lock:
+                self._fonts[key] = font
+        return font
+
+    def glyph(self, face, size, char):
+        key = (face, size, char)
+        glyph = self._glyphs.get(key)
+        if glyph is None:
+            glyph = self._rasterize(face, size, char)
+            with self._lock:
+                self._glyphs[key] = glyph
+        return glyph
+
+    def kerning(self, face, size, left, right):
+        # adjustment of the pen between two characters, in 1/64 pixel
+        key = (face, size, left, right)
+        kern = self._kerning.get(key)
+        if kern is None:
+            font = self.font(face, size)
+            kern = _round((font.getlength(left + right, '1') - font.getlength(left, '1')
+                           - font.getlength(right, '1')) * 64)
+            with self._lock:
+                self._kerning[key] = kern
+        return kern
+
+    def _layout(self, text, face, size):
+        # (pen position in 1/64 pixel, glyph) per character, and the end position
+        pen = 0
+        placed = []
+        for i, char in enumerate(text):
+            if i:
+                pen += self.kerning(face, size, text[i - 1], char)
+            glyph = self.glyph(face, size, char)
+            placed.append((pen, glyph))
+            pen += _round(glyph.advance * 64)
+        return placed, pen
+
+    def _rasterize(self, face, size, char):
+        font = self.font(face, size)
+        left, top, right, bottom = font.getbbox(char, '1')
+        advance = font.getlength(char, '1')
+        image, margin = _render(font, char)
+        box = image.getbbox()
+        if box is None:
+            return Glyph(None, left, top, right, bottom, advance)
+        mask = image.crop(box)
+        # Drawn alone, a glyph whose bitmap starts left of the pen is pulled
+        # back to the text origin, and vertically the line starts at the top of
+        # its box rather than of its bitmap.
+        alone_x = box[0] - margin - left
+        below_top = box[1] - margin - top
+
+        # In a line, after enough blank space that nothing reaches left of the
+        # origin, the ink lands ink_x from its pen.
+        ink_x = alone_x + min(left, 0)
+        line_box = None
+        space = font.getlength(' ', '1')
+        if space > 0:
+            blank = ' ' * math.ceil((2 - left) / space)
+            line, margin = _render(font, blank + char)
+            # None for glyphs entirely below the baseline, which PIL clips
+            # here; they are placed from the reference line below instead
+            line_box = line.getbbox()
+            if line_box is not None:
+                ink_x = line_box[0] - margin - _pixel(_round(font.getlength(blank, '1') * 64))
+        overhang = min(0, ink_x - alone_x)
+
+        # Rows are only known relative to another glyph in the same line, so
+        # everything is measured against the reference glyph.
+        reference = None if char == REFERENCE else self.glyph(face, size, REFERENCE)
+        if reference is None or reference.mask is None:
+            return Glyph(mask, left, top, right, bottom, advance, ink_x, 0, below_top, overhang)
+        gap = reference.ink_x + reference.mask.width + 2 - ink_x
+        blank = ' ' * max(1, math.ceil((gap - reference.advance) / space)) if space > 0 else ' '
+        pen = _pixel(_round(font.getlength(REFERENCE + blank, '1') * 64))
+        line, margin = _render(font, REFERENCE + blank + char)
+        split = margin + pen + min(ink_x, 0)
+        ref_box = line.crop((0, 0, split, line.height)).getbbox()
+        own_box = line.crop((split, 0, line.width, line.height)).getbbox()
+        if ref_box is None or own_box is None:
+            return Glyph(mask, left, top, right, bottom, advance, ink_x, 0, below_top, overhang)
+        ink_y = own_box[1] - ref_box[1]
+        if line_box is None:
+            ink_x = split + own_box[0] - margin - pen
+        return Glyph(mask, left, top, right, bottom, advance, ink_x, ink_y, below_top - ink_y, overhang)
+
+    def preload(self, face, size, chars):
+        # rasterise a known character set up front, e.g. '0123456789:'
+        for char in chars:
+            self.glyph(face, size, char)
+
+    def _bbox(self, placed, end):
+        # box of a laid out line relative to its origin; the pen line from the
+        # origin counts, as in PIL
+        left = bottom = 0
+        right = _pixel(end)
+        top = placed[0][1].top
+        for pen, glyph in placed:
+            px = _pixel(pen)
+            left = min(left, px + glyph.left)
+            right = max(right, px + glyph.right)
+            top = min(top, glyph.top)
+            bottom = max(bottom, glyph.bottom)
+        return left, top, right, bottom
+
+    def text_bbox(self, text, face, size, xy=(0, 0)):
+        # (left, top, right, bottom) of text drawn at xy, like draw.textbbox on a '1' image
+        x, y = xy
+        if not text:
+            return (x, y, x, y)
+        left, top, right, bottom = self._bbox(*self._layout(text, face, size))
+        return (x + left, y + top, x + right, y + bottom)
+
+    def text_length(self, text, face, size):
+        return self._layout(text, face, size)[1] / 64.0
+
+    def draw_text(self, image, xy, text, face, size, fill=255):
+        x, y = xy
+        if not text:
+            return
+        placed, end = self._layout(text, face, size)
+        left, top, right, bottom = self._bbox(placed, end)
+        bitmap_left = 0
+        rise = None
+        for pen, glyph in placed:
+            if glyph.mask is not None:
+                bitmap_left = min(bitmap_left, _pixel(pen) + glyph.overhang)
+                rise = glyph.rise if rise is None else max(rise, glyph.rise)
+        if rise is None:
+            return
+        # PIL renders the line into a mask of its box, grown by one pixel for a
+        # positive fractional position, which goes into the pen; ink that falls
+        # outside that mask is cut off
+        ix, iy = int(x), int(y)
+        fx, fy = x - ix, y - iy
+        clip = (ix + left, iy + top, ix + right + math.ceil(fx), iy + bottom + math.ceil(fy))
+        origin = _round((fx - bitmap_left) * 64)
+        row = iy + top + rise - _pixel(_round(-fy * 64))
+        for pen, glyph in placed:
+            if glyph.mask is None:
+                continue
+            gx = ix + left + _pixel(origin + pen) + glyph.ink_x
+            gy = row + glyph.ink_y
+            mask = glyph.mask
+            if gx < clip[0] or gy < clip[1] or gx + mask.width > clip[2] or gy + mask.height > clip[3]:
+                box = (max(clip[0] - gx, 0), max(clip[1] - gy, 0),
+                       min(clip[2] - gx, mask.width), min(clip[3] - gy, mask.height))
+                if box[0] >= box[2] or box[1] >= box[3]:
+                    continue
+                mask = mask.crop(box)
+                gx += box[0]
+                gy += box[1]
+            image.paste(fill, (gx, gy), mask)
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+            self._glyphs.clear()
+            self._kerning.clear()
+
+
+# shared instance for a process
+fonts = FontManager()
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Pre-rendered frame store: one file holding fixed-size packed frames plus an
+# index, memory-mapped so a frame can go to EPD.display as a memoryview without
+# being read into Python objects first.
+#
+# usage: python3 frame_store.py build IMAGE_DIR STORE [--workers N] [--full]
+#        python3 frame_store.py list STORE
+#        python3 frame_store.py show STORE NAME_OR_NUMBER [--backend sim|rpi]
+#
+# Layout: a 4096-byte header page (magic, version, frame size, panel size,
+# frame count, index offset and length), the frames back to back, then a JSON
+# index of [name, key] per frame. The key covers the source path, size, mtime
+# and the layout, so `build` re-renders only new or changed images and copies
+# the rest from the previous store. The new store is written next to the old
+# one and renamed over it; readers that still have the old file mapped are
+# unaffected.
+#
+#     with FrameStore('playlist.frames') as store:
+#         for name, frame in store:
+#             epd.display(frame)
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'EPFRAMES'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIIQQ')
+DATA_OFFSET = 4096
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tif', '.tiff')
+
+
+def source_key(path, **params):
+    st = os.stat(path)
+    blob = json.dumps([os.path.abspath(path), st.st_size, st.st_mtime_ns, params],
+                      sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+class FrameStore:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("%s is empty" % path)
+        magic, version, self.frame_size, self.width, self.height, count, index_offset, index_length = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("%s is not a frame store" % path)
+        index = json.loads(self._map[index_offset:index_offset + index_length])
+        if len(index) != count:
+            self.close()
+            raise ValueError("%s: index has %d entries, header says %d" % (path, len(index), count))
+        self.names = [name for name, key in index]
+        self.keys = [key for name, key in index]
+        self._slots = {name: i for i, name in enumerate(self.names)}
+        self._view = memoryview(self._map)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._slots
+
+    def frame(self, item):
+        # read-only memoryview into the mapping, by position or name
+        if not isinstance(item, int):
+            item = self._slots[item]
+        if not -len(self.names) <= item < len(self.names):
+            raise IndexError("frame %d out of range" % item)
+        start = DATA_OFFSET + (item % len(self.names)) * self.frame_size
+        return self._view[start:start + self.frame_size]
+
+    __getitem__ = frame
+
+    def __iter__(self):
+        for i, name in enumerate(self.names):
+            yield name, self.frame(i)
+
+    def close(self):
+        if getattr(self, '_view', None) is not None:
+            self._view.release()
+            self._view = None
+        try:
+            self._map.close()
+        except BufferError:
+            # frames handed out are still referenced, the mapping goes with them
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_store(path, frames, frame_size, width, height):
+    # frames: list of (name, key, frame bytes); written to path.tmp then renamed
+    index = json.dumps([[name, key] for name, key, frame in frames]).encode('utf-8')
+    index_offset = DATA_OFFSET + len(frames) * frame_size
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, frame_size, width, height, len(frames),
+                            index_offset, len(index)).ljust(DATA_OFFSET, b'\0'))
+        for name, key, frame in frames:
+            if len(frame) != frame_size:
+                raise ValueError("frame %s is %d bytes, expected %d" % (name, len(frame), frame_size))
+            f.write(frame)
+        f.write(index)
+    os.replace(tmp, path)
+
+
+def _render(path, layout):
+    # runs in a worker process
+    from display import compose_frame
+    from local_epaper_fns import EPD
+    epd = EPD()
+    return bytes(epd.getbuffer(compose_frame(path, epd.width, epd.height, **layout)))
+
+
+def list_images(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def build(store_path, sources, layout=None, workers=None, full=False):
+    # render sources (in this order) into store_path, reusing unchanged frames
+    from local_epaper_fns import EPD_WIDTH, EPD_HEIGHT
+    if layout is None:
+        from display import LAYOUT as layout
+    frame_size = EPD_WIDTH // 8 * EPD_HEIGHT
+
+    old = None
+    if not full and os.path.exists(store_path):
+        try:
+            old = FrameStore(store_path)
+        except ValueError as e:
+            logger.warning("rebuilding %s from scratch: %s", store_path, e)
+    try:
+        frames = []
+        todo = []
+        for path in sources:
+            name = os.path.basename(path)
+            key = source_key(path, width=EPD_WIDTH, height=EPD_HEIGHT, **layout)
+            if old is not None and name in old and old.keys[old._slots[name]] == key \
+                    and old.frame_size == frame_size:
+                frames.append([name, key, old.frame(name)])
+            else:
+                frames.append([name, key, None])
+                todo.append((len(frames) - 1, path))
+        reused = len(frames) - len(todo)
+        removed = 0 if old is None else len(set(old.names) - set(f[0] for f in frames))
+
+        # a source that fails to render is logged and left out of the store
+        failed = 0
+        if workers == 1 or len(todo) <= 1:
+            for i, path in todo:
+                try:
+                    frames[i][2] = _render(path, layout)
+                except Exception as e:
+                    logger.warning("skipping %s: %s", path, e)
+                    failed += 1
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(_render, path, layout): (i, path) for i, path in todo}
+                for future in concurrent.futures.as_completed(futures):
+                    i, path = futures[future]
+                    try:
+                        frames[i][2] = future.result()
+                    except Exception as e:
+                        logger.warning("skipping %s: %s", path, e)
+                        failed += 1
+        frames = [frame for frame in frames if frame[2] is not None]
+
+        write_store(store_path, frames, frame_size, EPD_WIDTH, EPD_HEIGHT)
+    finally:
+        frames = None
+        if old is not None:
+            old.close()
+    rendered = len(todo) - failed
+    logger.info("%s: %d rendered, %d reused, %d removed, %d failed", store_path, rendered, reused, removed, failed)
+    return {'rendered': rendered, 'reused': reused, 'removed': removed, 'failed': failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pre-rendered e-paper frame store")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('build', help="render a directory of images into a store")
+    p.add_argument('directory')
+    p.add_argument('store')
+    p.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    p.add_argument('--full', action='store_true', help="re-render everything")
+    p = sub.add_parser('list', help="list the frames in a store")
+    p.add_argument('store')
+    p = sub.add_parser('show', help="display one frame")
+    p.add_argument('store')
+    p.add_argument('frame', help="image name or position")
+    p.add_argument('--backend', default=None, help="sim or rpi")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'build':
+        build(args.store, list_images(args.directory), workers=args.workers, full=args.full)
+    elif args.command == 'list':
+        with FrameStore(args.store) as store:
+            for i, name in enumerate(store.names):
+                print("%4d  %s" % (i, name))
+    else:
+        from local_epaper_fns import EPD
+        with FrameStore(args.store) as store:
+            item = int(args.frame) if args.frame.isdigit() else args.frame
+            if not isinstance(item, int) and item not in store:
+                sys.exit("no frame %r in %s" % (item, args.store))
+            epd = EPD(args.backend)
+            epd.init()
+            epd.display(store.frame(item))
+            epd.sleep()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,135 @@ import sys
 import os
 import logging
 import time
-import subprocess
-from PIL import Image,ImageDraw,ImageFont
-import traceback
-from ctypes import *
+import json
+import struct
+import threading
+import functools
+
+# PIL, ctypes, spidev and gpiozero are imported where they are first needed,
+# so importing this module stays cheap and touches no hardware
+
+# Display resolution
+EPD_WIDTH       = 800
+EPD_HEIGHT      = 480
+
+logger = logging.getLogger(__name__)
+
+# SPI transfer settings. Explicit RaspberryPi() arguments win over the
+# EPAPER_SPI_* environment variables, which win over a saved calibration
+# (see calibrate_spi), which wins over the defaults below.
+SPI_SPEED_HZ = 4000000
+SPI_SPEEDS = (4000000, 8000000, 10000000, 16000000, 20000000, 24000000, 32000000)
+SPI_CALIBRATION_FILE = os.environ.get('EPAPER_SPI_CALIBRATION',
+    os.path.join(os.path.expanduser('~'), '.config', 'epaper', 'spi.json'))
+
+def spidev_bufsiz(default=4096):
+    # largest single transfer the spidev driver accepts
+    try:
+        with open('/sys/module/spidev/parameters/bufsiz') as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return default
+
+def board_model():
+    # e.g. 'Raspberry Pi Zero W Rev 1.1', calibrations are stored per model
+    try:
+        with open('/proc/device-tree/model', 'rb') as f:
+            return f.read().rstrip(b'\x00').decode('ascii', 'replace')
+    except (IOError, OSError):
+        import platform
+        return platform.machine() or 'unknown'
+
+def load_spi_calibration(path=None, model=None):
+    try:
+        with open(path or SPI_CALIBRATION_FILE) as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    entry = saved.get(model or board_model())
+    return entry['speed_hz'] if entry else None
+
+def save_spi_calibration(speed_hz, method, path=None, model=None):
+    path = path or SPI_CALIBRATION_FILE
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        saved = {}
+    saved[model or board_model()] = {'speed_hz': speed_hz, 'method': method, 'time': int(time.time())}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(saved, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+_dev_config = []
+
+def dev_config_path():
+    # DEV_Config_32.so or DEV_Config_64.so for this interpreter, looked up once
+    if not _dev_config:
+        bits = struct.calcsize('P') * 8
+        logger.debug("System is %d bit", bits)
+        so_name = 'DEV_Config_64.so' if bits == 64 else 'DEV_Config_32.so'
+        _dev_config.append(None)
+        for find_dir in [os.path.dirname(os.path.realpath(__file__)), '/usr/local/lib', '/usr/lib']:
+            so_filename = os.path.join(find_dir, so_name)
+            if os.path.exists(so_filename):
+                _dev_config[0] = so_filename
+                break
+    return _dev_config[0]
+
+class _SharedOutput:
+    # One gpiozero output for a pin driven by several backends, e.g. the HAT's
+    # PWR line feeding two panels. It stays on while any user has it on.
+    _outputs = {}
+    _lock = threading.Lock()
+
+    def __init__(self, device):
+        self.device = device
+        self.users_on = set()
+        self.users = 0
+
+    @classmethod
+    def claim(cls, pin):
+        with cls._lock:
+            shared = cls._outputs.get(pin)
+            if shared is None:
+                import gpiozero
+                shared = cls._outputs[pin] = cls(gpiozero.LED(pin))
+            shared.users += 1
+            return _SharedPin(shared, pin)
+
+class _SharedPin:
+    def __init__(self, shared, pin):
+        self.shared = shared
+        self.pin = pin
+
+    @property
+    def value(self):
+        return self.shared.device.value
+
+    def on(self):
+        with _SharedOutput._lock:
+            self.shared.users_on.add(self)
+            self.shared.device.on()
+
+    def off(self):
+        with _SharedOutput._lock:
+            self.shared.users_on.discard(self)
+            if not self.shared.users_on:
+                self.shared.device.off()
+
+    def close(self):
+        self.off()
+        with _SharedOutput._lock:
+            self.shared.users -= 1
+            if not self.shared.users:
+                self.shared.device.close()
+                del _SharedOutput._outputs[self.pin]
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value, 0) if value else None
 
 class RaspberryPi:
     # Pin definition
@@ -17,15 +142,44 @@ class RaspberryPi:
     MOSI_PIN = 10
     SCLK_PIN = 11
 
-    def __init__(self):
+    def __init__(self, spi_bus=None, spi_device=None, spi_speed=None, spi_mode=None, chunk_size=None,
+                 rst_pin=None, dc_pin=None, busy_pin=None, pwr_pin=None):
+        # Pins and SPI device are per instance, so several panels can be driven
+        # from one host, e.g. RaspberryPi(spi_device=1, rst_pin=..., dc_pin=...,
+        # busy_pin=...) on CE1. The PWR pin may be shared between instances.
         import spidev
         import gpiozero
 
+        def pick(value, env, default):
+            if value is not None:
+                return value
+            value = _env_int(env)
+            return default if value is None else value
+
+        self.spi_bus = pick(spi_bus, 'EPAPER_SPI_BUS', 0)
+        self.spi_device = pick(spi_device, 'EPAPER_SPI_DEVICE', 0)
+        self.spi_speed = pick(spi_speed, 'EPAPER_SPI_HZ', None) or load_spi_calibration() or SPI_SPEED_HZ
+        self.spi_mode = pick(spi_mode, 'EPAPER_SPI_MODE', 0b00)
+        # writes longer than this are split, spidev rejects anything above bufsiz
+        self.chunk_size = pick(chunk_size, 'EPAPER_SPI_CHUNK', None) or spidev_bufsiz()
+
+        if rst_pin is not None:
+            self.RST_PIN = rst_pin
+        if dc_pin is not None:
+            self.DC_PIN = dc_pin
+        if busy_pin is not None:
+            self.BUSY_PIN = busy_pin
+        if pwr_pin is not None:
+            self.PWR_PIN = pwr_pin
+        # hardware chip select: CE0 is GPIO 8, CE1 GPIO 7
+        self.CS_PIN = {0: 8, 1: 7}.get(self.spi_device, self.CS_PIN)
+
         self.SPI = spidev.SpiDev()
         self.GPIO_RST_PIN    = gpiozero.LED(self.RST_PIN)
         self.GPIO_DC_PIN     = gpiozero.LED(self.DC_PIN)
-        self.GPIO_PWR_PIN    = gpiozero.LED(self.PWR_PIN)
+        self.GPIO_PWR_PIN    = _SharedOutput.claim(self.PWR_PIN)
         self.GPIO_BUSY_PIN   = gpiozero.Button(self.BUSY_PIN, pull_up = False)
+        self.spi_open = False
 
 
 
@@ -57,6 +211,11 @@ class RaspberryPi:
         elif pin == self.PWR_PIN:
             return self.PWR_PIN.value
 
+    def busy_wait(self, timeout=None):
+        # BUSY goes high when the panel is idle. gpiozero sets an event from the
+        # pin's edge callback, so the waiting thread sleeps instead of polling.
+        return self.GPIO_BUSY_PIN.wait_for_active(timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -64,7 +223,22 @@ class RaspberryPi:
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        self.SPI.writebytes2(data)
+        if len(data) <= self.chunk_size:
+            self.SPI.writebytes2(data)
+            return
+        # lists (accepted by writebytes2 as well) are sliced as they are
+        view = data if isinstance(data, list) else memoryview(data)
+        for offset in range(0, len(view), self.chunk_size):
+            self.SPI.writebytes2(view[offset:offset + self.chunk_size])
+
+    def spi_transfer(self, data):
+        # full-duplex transfer, returns what was clocked in on MISO
+        return bytes(self.SPI.xfer2(list(data)))
+
+    def set_speed(self, hz):
+        self.spi_speed = hz
+        if self.spi_open:
+            self.SPI.max_speed_hz = hz
 
     def DEV_SPI_write(self, data):
         self.DEV_SPI.DEV_SPI_SendData(data)
@@ -77,39 +251,30 @@ class RaspberryPi:
 
     def module_init(self, cleanup=False):
         self.GPIO_PWR_PIN.on()
+        if self.spi_open:
+            return 0
         
         if cleanup:
-            find_dirs = [
-                os.path.dirname(os.path.realpath(__file__)),
-                '/usr/local/lib',
-                '/usr/lib',
-            ]
-            self.DEV_SPI = None
-            for find_dir in find_dirs:
-                val = int(os.popen('getconf LONG_BIT').read())
-                logging.debug("System is %d bit"%val)
-                if val == 64:
-                    so_filename = os.path.join(find_dir, 'DEV_Config_64.so')
-                else:
-                    so_filename = os.path.join(find_dir, 'DEV_Config_32.so')
-                if os.path.exists(so_filename):
-                    self.DEV_SPI = CDLL(so_filename)
-                    break
-            if self.DEV_SPI is None:
-                RuntimeError('Cannot find DEV_Config.so')
-
+            from ctypes import CDLL
+            so_filename = dev_config_path()
+            if so_filename is None:
+                raise RuntimeError('Cannot find DEV_Config.so')
+            self.DEV_SPI = CDLL(so_filename)
             self.DEV_SPI.DEV_Module_Init()
 
         else:
-            # SPI device, bus = 0, device = 0
-            self.SPI.open(0, 0)
-            self.SPI.max_speed_hz = 4000000
-            self.SPI.mode = 0b00
+            self.SPI.open(self.spi_bus, self.spi_device)
+            self.SPI.max_speed_hz = self.spi_speed
+            self.SPI.mode = self.spi_mode
+            logger.debug("SPI %d.%d at %d Hz, mode %d, %d byte chunks", self.spi_bus,
+                         self.spi_device, self.spi_speed, self.spi_mode, self.chunk_size)
+        self.spi_open = True
         return 0
 
     def module_exit(self, cleanup=False):
         logger.debug("spi end")
         self.SPI.close()
+        self.spi_open = False
 
         self.GPIO_RST_PIN.off()
         self.GPIO_DC_PIN.off()
@@ -122,31 +287,607 @@ class RaspberryPi:
             self.GPIO_PWR_PIN.close()
             self.GPIO_BUSY_PIN.close()
 
-implementation = RaspberryPi()
+class NativeBackend(RaspberryPi):
+    # Same pins as RaspberryPi (gpiozero), but SPI goes through Waveshare's
+    # DEV_Config_32.so/DEV_Config_64.so. Whole planes and LUT tables are handed
+    # to DEV_SPI_Write_nByte(uint8_t *data, uint32_t len) as one pointer +
+    # length: bytearrays are passed in place with from_buffer and bytes through
+    # c_char_p, so no per-byte conversion happens in Python. The clock is fixed
+    # by the library.
+    # DEV_SPI_SendnData(UBYTE *Reg) takes no length (the published
+    # DEV_Config.c sends sizeof(Reg), i.e. 4 or 8 bytes), so it is never used
+    # and a library without DEV_SPI_Write_nByte is refused. Not in BACKENDS
+    # until checked on hardware; use EPD(NativeBackend()).
+    set_speed = None
+    spi_transfer = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.DEV_SPI = None
+
+    def _load(self):
+        import ctypes
+        so_filename = dev_config_path()
+        if so_filename is None:
+            raise RuntimeError('Cannot find DEV_Config.so')
+        lib = ctypes.CDLL(so_filename)
+        if not hasattr(lib, 'DEV_SPI_Write_nByte'):
+            raise RuntimeError('%s has no DEV_SPI_Write_nByte; DEV_SPI_SendnData cannot be given a length' % so_filename)
+        lib.DEV_Module_Init.restype = ctypes.c_uint8
+        lib.DEV_Module_Init.argtypes = []
+        lib.DEV_Module_Exit.restype = None
+        lib.DEV_Module_Exit.argtypes = []
+        lib.DEV_SPI_SendData.restype = None
+        lib.DEV_SPI_SendData.argtypes = [ctypes.c_uint8]
+        lib.DEV_SPI_Write_nByte.restype = None
+        lib.DEV_SPI_Write_nByte.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        self._ctypes = ctypes
+        return lib
 
-for func in [x for x in dir(implementation) if not x.startswith('_')]:
-    setattr(sys.modules[__name__], func, getattr(implementation, func))
+    def spi_writebyte(self, data):
+        if len(data) == 1:
+            self.DEV_SPI.DEV_SPI_SendData(data[0])
+        else:
+            self.spi_writebyte2(bytes(data))
 
-# Display resolution
-EPD_WIDTH       = 800
-EPD_HEIGHT      = 480
+    def spi_writebyte2(self, data):
+        ctypes = self._ctypes
+        if isinstance(data, bytes):
+            pointer = ctypes.c_char_p(data)
+        else:
+            try:
+                # bytearray or writable memoryview: the buffer itself
+                pointer = (ctypes.c_uint8 * len(data)).from_buffer(data)
+            except TypeError:
+                # list or read-only memoryview, a single copy
+                data = bytes(data)
+                pointer = ctypes.c_char_p(data)
+        self.DEV_SPI.DEV_SPI_Write_nByte(pointer, len(data))
 
-logger = logging.getLogger(__name__)
+    def module_init(self, cleanup=False):
+        self.GPIO_PWR_PIN.on()
+        if self.spi_open:
+            return 0
+        if self.DEV_SPI is None:
+            self.DEV_SPI = self._load()
+        if self.DEV_SPI.DEV_Module_Init() != 0:
+            raise RuntimeError('DEV_Module_Init failed')
+        self.spi_open = True
+        return 0
+
+    def module_exit(self, cleanup=False):
+        logger.debug("spi end")
+        if self.spi_open:
+            self.DEV_SPI.DEV_Module_Exit()
+        self.spi_open = False
+
+        self.GPIO_RST_PIN.off()
+        self.GPIO_DC_PIN.off()
+        self.GPIO_PWR_PIN.off()
+        logger.debug("close 5V, Module enters 0 power consumption ...")
+
+        if cleanup:
+            self.GPIO_RST_PIN.close()
+            self.GPIO_DC_PIN.close()
+            self.GPIO_PWR_PIN.close()
+            self.GPIO_BUSY_PIN.close()
+
+class SimulatedPanel:
+    # Pure-Python stand-in for the panel: decodes the command/data stream into
+    # controller RAM, emulates BUSY timing and keeps the visible image in memory.
+    RST_PIN  = RaspberryPi.RST_PIN
+    DC_PIN   = RaspberryPi.DC_PIN
+    CS_PIN   = RaspberryPi.CS_PIN
+    BUSY_PIN = RaspberryPi.BUSY_PIN
+    PWR_PIN  = RaspberryPi.PWR_PIN
+
+    # how long BUSY stays low after a command, in ms
+    BUSY_MS = {
+        0x02: 100,      # power off
+        0x04: 100,      # power on
+        0x12: 3000,     # full refresh
+    }
+    PARTIAL_REFRESH_MS = 500
+
+    def __init__(self, width=None, height=None, time_scale=None, png_path=None, max_spi_hz=None):
+        self.width = width or EPD_WIDTH
+        self.height = height or EPD_HEIGHT
+        # 1.0 sleeps and holds BUSY like the real panel, 0 runs at full speed
+        if time_scale is None:
+            time_scale = float(os.environ.get('EPAPER_SIM_TIME_SCALE', 1.0))
+        self.time_scale = time_scale
+        # write the visible image here after every refresh
+        self.png_path = png_path or os.environ.get('EPAPER_SIM_PNG')
+        # above this clock every byte arrives with bit 7 flipped, for
+        # exercising calibrate_spi; None never corrupts
+        self.max_spi_hz = max_spi_hz or _env_int('EPAPER_SIM_MAX_SPI_HZ')
+        self.spi_speed = SPI_SPEED_HZ
+
+        size = (self.width + 7) // 8 * self.height
+        self.old_ram = bytearray(size)
+        self.new_ram = bytearray(size)
+        self.visible = bytearray(size)
+
+        self.pins = {self.RST_PIN: 0, self.DC_PIN: 0, self.PWR_PIN: 0}
+        self.spi_open = False
+        self.busy_until = 0.0
+        self.bytes_sent = 0
+        self.transfers = 0
+        self.refreshes = 0
+        self._power_reset()
+
+    def _power_reset(self):
+        self.registers = {}
+        self.command = None
+        self.data = bytearray()
+        self.powered = False
+        self.asleep = False
+        self.partial = False
+
+    def digital_write(self, pin, value):
+        if pin == self.RST_PIN and value and not self.pins[pin]:
+            self._power_reset()
+        if pin in self.pins:
+            self.pins[pin] = 1 if value else 0
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            return 0 if time.monotonic() < self.busy_until else 1
+        return self.pins.get(pin, 0)
+
+    def busy_wait(self, timeout=None):
+        remaining = self.busy_until - time.monotonic()
+        if remaining <= 0:
+            return True
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(remaining)
+        return True
+
+    def delay_ms(self, delaytime):
+        if self.time_scale:
+            time.sleep(delaytime * self.time_scale / 1000.0)
+
+    def spi_writebyte(self, data):
+        self.spi_writebyte2(bytes(data))
+
+    def set_speed(self, hz):
+        self.spi_speed = hz
+
+    def _wire(self, data):
+        if self.max_spi_hz and self.spi_speed > self.max_spi_hz:
+            return bytes(b ^ 0x80 for b in data)
+        return data
+
+    def spi_transfer(self, data):
+        # as if MOSI were looped back to MISO
+        self.transfers += 1
+        self.bytes_sent += len(data)
+        return self._wire(bytes(data))
+
+    def spi_writebyte2(self, data):
+        if isinstance(data, list):
+            data = bytes(data)
+        data = self._wire(data)
+        self.transfers += 1
+        self.bytes_sent += len(data)
+        if not self.spi_open:
+            logger.warning("simulated panel: SPI write while SPI is closed")
+        if self.asleep:
+            return
+        if self.pins[self.DC_PIN]:
+            self.data += data
+            if self.command == 0x07 and self.data[:1] == b'\xA5':
+                self.asleep = True
+        else:
+            for command in bytes(data):
+                self._start(command)
+
+    def _start(self, command):
+        self._finish()
+        self.command = command
+        if command == 0x04:
+            self.powered = True
+        elif command == 0x02:
+            self.powered = False
+        elif command == 0x91:
+            self.partial = True
+        elif command == 0x92:
+            self.partial = False
+        elif command == 0x12:
+            self._refresh()
+        if command in self.BUSY_MS and command != 0x12:
+            self._busy(self.BUSY_MS[command])
+
+    def _finish(self):
+        # apply the data collected for the previous command
+        command, data = self.command, bytes(self.data)
+        self.command = None
+        self.data = bytearray()
+        if command is None:
+            return
+        if command in (0x10, 0x13):
+            self._write_ram(self.old_ram if command == 0x10 else self.new_ram, data)
+        elif data:
+            self.registers[command] = data
+
+    def _window(self):
+        # (first byte column, last byte column + 1, first row, last row + 1)
+        if self.partial and len(self.registers.get(0x90, b'')) >= 8:
+            r = self.registers[0x90]
+            return (((r[0] << 8) | r[1]) // 8, ((r[2] << 8) | r[3]) // 8 + 1,
+                    (r[4] << 8) | r[5], ((r[6] << 8) | r[7]) + 1)
+        return 0, self.width // 8, 0, self.height
+
+    def _write_ram(self, ram, data):
+        x0, x1, y0, y1 = self._window()
+        row = self.width // 8
+        span = x1 - x0
+        for j in range(min(y1 - y0, len(data) // span)):
+            start = (y0 + j) * row + x0
+            ram[start:start + span] = data[j * span:(j + 1) * span]
+
+    def _refresh(self):
+        if not self.powered:
+            logger.warning("simulated panel: refresh while powered off")
+        x0, x1, y0, y1 = self._window()
+        row = self.width // 8
+        ram = self.new_ram
+        # DDX[0] of the VCOM and data interval setting flips the data polarity
+        if self.registers.get(0x50, b'\x10')[0] & 0x01:
+            ram = ram.translate(INVERT_TABLE)
+        # UD and SHL cleared in the panel setting: RAM is scanned out backwards
+        if not self.registers.get(0x00, b'\x0C')[0] & 0x0C:
+            ram = ram[::-1].translate(BIT_REVERSE_TABLE)
+            x0, x1, y0, y1 = row - x1, row - x0, self.height - y1, self.height - y0
+        for y in range(y0, y1):
+            self.visible[y * row + x0:y * row + x1] = ram[y * row + x0:y * row + x1]
+        self.refreshes += 1
+        self._busy(self.PARTIAL_REFRESH_MS if self.partial else self.BUSY_MS[0x12])
+        if self.png_path:
+            self.save_png(self.png_path)
+
+    def _busy(self, ms):
+        self.busy_until = time.monotonic() + ms * self.time_scale / 1000.0
+
+    def image(self):
+        from PIL import Image
+        return Image.frombytes('1', (self.width, self.height), bytes(self.visible), 'raw', '1;I')
+
+    def save_png(self, path):
+        self.image().save(path, 'PNG')
+
+    def module_init(self, cleanup=False):
+        self.pins[self.PWR_PIN] = 1
+        self.spi_open = True
+        return 0
+
+    def module_exit(self, cleanup=False):
+        self._finish()
+        self.spi_open = False
+        for pin in self.pins:
+            self.pins[pin] = 0
+
+# Backends by name, selected with EPD(backend=...) or the EPAPER_BACKEND variable
+BACKENDS = {
+    'rpi': RaspberryPi,
+    'sim': SimulatedPanel,
+}
+
+_backends = {}
+
+def get_backend(name=None):
+    # one shared instance per backend, created on first use
+    if name is None:
+        name = os.environ.get('EPAPER_BACKEND', 'rpi')
+    if name not in _backends:
+        if name not in BACKENDS:
+            raise ValueError("Unknown e-Paper backend %r, expected one of %s" % (name, ', '.join(BACKENDS)))
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+# Module-level pin/SPI functions act on the default backend, created on first call
+def _backend_function(name):
+    def call(*args, **kwargs):
+        return getattr(get_backend(), name)(*args, **kwargs)
+    call.__name__ = name
+    return call
+
+for func in ['digital_write', 'digital_read', 'delay_ms', 'busy_wait',
+             'spi_writebyte', 'spi_writebyte2', 'DEV_SPI_write', 'DEV_SPI_nwrite',
+             'DEV_SPI_read', 'module_init', 'module_exit']:
+    setattr(sys.modules[__name__], func, _backend_function(func))
+
+for pin in ['RST_PIN', 'DC_PIN', 'CS_PIN', 'BUSY_PIN', 'PWR_PIN', 'MOSI_PIN', 'SCLK_PIN']:
+    setattr(sys.modules[__name__], pin, getattr(RaspberryPi, pin))
+
+def __getattr__(name):
+    # the default backend instance, as the module used to expose it
+    if name == 'implementation':
+        return get_backend()
+    # PIL modules the module used to re-export, imported on first access
+    if name in ('Image', 'ImageDraw', 'ImageFont'):
+        import importlib
+        return importlib.import_module('PIL.' + name)
+    if name == 'traceback':
+        import traceback
+        return traceback
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+# `from local_epaper_fns import *` as the Waveshare examples use it: star imports
+# skip __getattr__, so the lazily imported names have to be listed here.
+# `implementation` is left out, it would open the hardware.
+__all__ = [
+    'EPD_WIDTH', 'EPD_HEIGHT', 'SPI_SPEED_HZ', 'SPI_SPEEDS', 'SPI_CALIBRATION_FILE',
+    'spidev_bufsiz', 'board_model', 'load_spi_calibration', 'save_spi_calibration', 'dev_config_path',
+    'RaspberryPi', 'NativeBackend', 'SimulatedPanel', 'BACKENDS', 'get_backend',
+    'digital_write', 'digital_read', 'delay_ms', 'busy_wait', 'spi_writebyte', 'spi_writebyte2',
+    'DEV_SPI_write', 'DEV_SPI_nwrite', 'DEV_SPI_read', 'module_init', 'module_exit',
+    'RST_PIN', 'DC_PIN', 'CS_PIN', 'BUSY_PIN', 'PWR_PIN', 'MOSI_PIN', 'SCLK_PIN',
+    'BusyTimeoutError', 'DriverStats', 'stats', 'INVERT_TABLE', 'BIT_REVERSE_TABLE',
+    'load_image', 'EPD', 'calibrate_spi',
+    'Image', 'ImageDraw', 'ImageFont',
+    'sys', 'os', 'logging', 'time', 'traceback',
+]
+
+class BusyTimeoutError(RuntimeError):
+    pass
+
+class DriverStats:
+    # Per-phase durations, SPI bytes/transfers per command and busy-wait counts.
+    # Enable with stats.enabled = True or EPAPER_STATS=1; when disabled the
+    # driver only checks the flag. EPAPER_STATS_FILE names an optional export
+    # file written after every refresh: Prometheus text format for *.prom,
+    # otherwise one JSON line per refresh.
+    def __init__(self, enabled=False, path=None):
+        self.enabled = enabled
+        self.path = path
+        # several EPDs on different threads may share one DriverStats; export
+        # holds it while it builds the snapshot, hence reentrant
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # phase -> [count, total seconds, max seconds]
+            self.phases = {}
+            # command -> [transfers, bytes], command and data bytes both counted
+            self.spi = {}
+            self.busy_waits = 0
+            self.busy_polls = 0
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                self.phases[name] = [1, seconds, seconds]
+            else:
+                phase[0] += 1
+                phase[1] += seconds
+                if seconds > phase[2]:
+                    phase[2] = seconds
+
+    def add_spi(self, command, nbytes):
+        with self._lock:
+            counts = self.spi.get(command)
+            if counts is None:
+                self.spi[command] = [1, nbytes]
+            else:
+                counts[0] += 1
+                counts[1] += nbytes
+
+    def add_busy_wait(self):
+        with self._lock:
+            self.busy_waits += 1
+
+    def add_busy_poll(self):
+        with self._lock:
+            self.busy_polls += 1
+
+    def _copy(self):
+        # consistent copy of the counters while other threads keep adding
+        with self._lock:
+            return ({name: tuple(v) for name, v in self.phases.items()},
+                    {command: tuple(v) for command, v in self.spi.items()},
+                    self.busy_waits, self.busy_polls)
+
+    def snapshot(self):
+        phases, spi, busy_waits, busy_polls = self._copy()
+        return {
+            'time': time.time(),
+            'phases': {name: {'count': c, 'seconds': t, 'max_seconds': m}
+                       for name, (c, t, m) in phases.items()},
+            'spi': {'0x%02X' % command: {'transfers': n, 'bytes': b}
+                    for command, (n, b) in spi.items()},
+            'busy_waits': busy_waits,
+            'busy_polls': busy_polls,
+        }
+
+    def prometheus(self):
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP epaper_%s %s' % (name, help))
+            lines.append('# TYPE epaper_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('epaper_%s%s %s' % (name, labels, repr(value)))
+        phases, spi, busy_waits, busy_polls = self._copy()
+        phases = sorted(phases.items())
+        metric('phase_seconds_total', 'counter', 'Time spent per driver phase.',
+               [('{phase="%s"}' % name, v[1]) for name, v in phases])
+        metric('phase_count_total', 'counter', 'Number of times each driver phase ran.',
+               [('{phase="%s"}' % name, v[0]) for name, v in phases])
+        metric('phase_seconds_max', 'gauge', 'Longest run of each driver phase.',
+               [('{phase="%s"}' % name, v[2]) for name, v in phases])
+        spi = sorted(spi.items())
+        metric('spi_bytes_total', 'counter', 'SPI bytes sent per command.',
+               [('{command="0x%02X"}' % command, v[1]) for command, v in spi])
+        metric('spi_transfers_total', 'counter', 'SPI transfers per command.',
+               [('{command="0x%02X"}' % command, v[0]) for command, v in spi])
+        metric('busy_waits_total', 'counter', 'BUSY waits.', [('', busy_waits)])
+        metric('busy_polls_total', 'counter', 'BUSY status polls in polling mode.', [('', busy_polls)])
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            if path.endswith('.prom'):
+                # write-then-rename so collectors never read a partial file
+                with open(path + '.tmp', 'w') as f:
+                    f.write(self.prometheus())
+                os.replace(path + '.tmp', path)
+            else:
+                with open(path, 'a') as f:
+                    f.write(json.dumps(self.snapshot(), sort_keys=True) + '\n')
+
+# shared by all EPD instances unless one is given its own
+stats = DriverStats(enabled=os.environ.get('EPAPER_STATS', '') not in ('', '0'),
+                    path=os.environ.get('EPAPER_STATS_FILE'))
+
+# byte -> inverted byte, for bytes.translate
+INVERT_TABLE = bytes(range(0xFF, -1, -1))
+# byte -> byte with its bit order reversed
+BIT_REVERSE_TABLE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+def load_image(source, size, mode='L'):
+    # Open source (a path or file object) already scaled to size (w, h). JPEGs
+    # are decoded at 1/2, 1/4 or 1/8 scale and straight to grey (Image.draft),
+    # so the full-resolution RGB image never exists; other formats get an
+    # integer box reduce(). What is left is a less than 2x LANCZOS resize.
+    from PIL import Image
+    width, height = size
+    # '1' is dithered from grey after the resize
+    working = 'L' if mode == '1' else mode
+    img = Image.open(source)
+    if img.format == 'JPEG':
+        img.draft(working if working in ('L', 'RGB') else 'RGB', (width, height))
+    factor = min(img.width // width, img.height // height)
+    if factor >= 2:
+        # reduce() averages channel values, so palette, 1-bit and 16-bit
+        # images are converted first
+        if img.mode not in ('L', 'LA', 'RGB', 'RGBA', working):
+            img = img.convert(working)
+        img = img.reduce(factor)
+    if img.mode != working:
+        img = img.convert(working)
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.LANCZOS)
+    if mode == '1':
+        img = img.convert('1')
+    return img
+
+def _locked(method):
+    # EPD methods that talk to the panel run under the instance lock, shared
+    # with the idle timers
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return call
 
 class EPD:
-    def __init__(self):
-        self.reset_pin = RST_PIN
-        self.dc_pin = DC_PIN
-        self.busy_pin = BUSY_PIN
-        self.cs_pin = CS_PIN
+    def __init__(self, backend=None, busy_timeout=30.0, stats=None, orientation=0,
+                 idle_power_off=None, idle_sleep=None):
+        # backend name (see BACKENDS), backend instance, or None for the default
+        self._backend = backend
+        # DriverStats collecting timings, the module-wide one by default
+        self.stats = stats if stats is not None else globals()['stats']
+        # command the following data bytes belong to, for the SPI stats
+        self._command = None
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        self.frame_size = (self.width + 7) // 8 * self.height
+
+        # constant planes for Clear, and the reused old-data plane for display
+        self._white_plane = b'\xFF' * self.frame_size
+        self._black_plane = bytes(self.frame_size)
+
+        # seconds to wait for BUSY release before giving up (None waits forever)
+        self.busy_timeout = busy_timeout
+        # poll BUSY instead of waiting for its edge
+        self.busy_poll = False
+
+        # last level written to the DC pin, None when unknown
+        self._dc_state = None
+
+        # last frame pushed to the panel, used by display_auto to find changes
+        self._last_frame = None
+        # changed-area fraction above which display_auto does a full refresh
+        self.partial_threshold = 0.5
+        # partial window mode (0x91) active, and the 0x50 setting to restore after it
+        self._partial = False
+        self._cdi = None
+
+        # controller state: out of reset (not in deep sleep), powered on, the
+        # waveform mode of the last init, and the last payload written to each
+        # register so unchanged registers (LUTs included) are not re-sent
+        self._awake = False
+        self._powered = False
+        self.mode = None
+        self._registers = {}
+        # serialises everything that talks to the panel: refreshes, inits,
+        # the idle timer and orientation changes
+        self._lock = threading.RLock()
+
+        # 0/90/180/270: images are drawn on a canvas of the rotated (logical)
+        # size, see the orientation property
+        self._orientation = 0
+        self.orientation = orientation
+
+        # Idle policy, in seconds since the last refresh or power on (None
+        # disables): power the booster off (0x02) after idle_power_off, deep
+        # sleep (0x07) after idle_sleep. The next refresh wakes the panel the
+        # shortest way back: POWER ON alone after a power off; reset, the
+        # registers and the LUT of the last mode after deep sleep.
+        self.idle_power_off = idle_power_off
+        self.idle_sleep = idle_sleep
+        self._idle_timer = None
+        self._idle_generation = 0
+        # waveform mode to restore when a refresh finds the panel asleep
+        self._resume_mode = None
+        # token of a deep sleep whose delayed module_exit has not run yet
+        self._sleep_pending = None
     
+    @property
+    def backend(self):
+        if self._backend is None or isinstance(self._backend, str):
+            self._backend = get_backend(self._backend)
+        return self._backend
+
+    # pins come from the backend instance, so each EPD can have its own wiring
+    @property
+    def reset_pin(self):
+        return self.backend.RST_PIN
+
+    @property
+    def dc_pin(self):
+        return self.backend.DC_PIN
+
+    @property
+    def busy_pin(self):
+        return self.backend.BUSY_PIN
+
+    @property
+    def cs_pin(self):
+        return self.backend.CS_PIN
+
+    # controller state, read-only: out of reset (not in deep sleep), and the
+    # booster/panel power on
+    @property
+    def awake(self):
+        return self._awake
+
+    @property
+    def powered(self):
+        return self._powered
+
     Voltage_Frame_7IN5_V2 = [
         0x6, 0x3F, 0x3F, 0x11, 0x24, 0x7, 0x17,
     ]
 
-    LUT_VCOM_7IN5_V2 = [
+    LUT_VCOM_7IN5_V2 = bytes([
         0x0,    0xF,    0xF,    0x0,    0x0,    0x1,
         0x0,    0xF,    0x1,    0xF,    0x1,    0x2,
         0x0,    0xF,    0xF,    0x0,    0x0,    0x1,
@@ -154,9 +895,9 @@ class EPD:
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
-    ]
+    ])
 
-    LUT_WW_7IN5_V2 = [
+    LUT_WW_7IN5_V2 = bytes([
         0x10,   0xF,    0xF,    0x0,    0x0,    0x1,
         0x84,   0xF,    0x1,    0xF,    0x1,    0x2,
         0x20,   0xF,    0xF,    0x0,    0x0,    0x1,
@@ -164,9 +905,9 @@ class EPD:
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
-    ]
+    ])
 
-    LUT_BW_7IN5_V2 = [
+    LUT_BW_7IN5_V2 = bytes([
         0x10,   0xF,    0xF,    0x0,    0x0,    0x1,
         0x84,   0xF,    0x1,    0xF,    0x1,    0x2,
         0x20,   0xF,    0xF,    0x0,    0x0,    0x1,
@@ -174,9 +915,9 @@ class EPD:
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
-    ]
+    ])
 
-    LUT_WB_7IN5_V2 = [
+    LUT_WB_7IN5_V2 = bytes([
         0x80,   0xF,    0xF,    0x0,    0x0,    0x1,
         0x84,   0xF,    0x1,    0xF,    0x1,    0x2,
         0x40,   0xF,    0xF,    0x0,    0x0,    0x1,
@@ -184,9 +925,9 @@ class EPD:
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
-    ]
+    ])
 
-    LUT_BB_7IN5_V2 = [
+    LUT_BB_7IN5_V2 = bytes([
         0x80,   0xF,    0xF,    0x0,    0x0,    0x1,
         0x84,   0xF,    0x1,    0xF,    0x1,    0x2,
         0x40,   0xF,    0xF,    0x0,    0x0,    0x1,
@@ -194,9 +935,9 @@ class EPD:
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
         0x0,    0x0,    0x0,    0x0,    0x0,    0x0,
-    ]
+    ])
 
-    Lut_all_fresh = [0x67,        0xBF,   0x3F,   0x0D,   0x00,   0x1C,
+    Lut_all_fresh = bytes([0x67,        0xBF,   0x3F,   0x0D,   0x00,   0x1C,
     #VCOM
     0x00,       0x32,   0x32,   0x00,   0x00,   0x01,
     0x00,       0x0A,   0x0A,   0x00,   0x00,   0x00,
@@ -244,9 +985,9 @@ class EPD:
     0xFF,       0xFF,   0xFF,   0xFF,   0xFF,   0xFF,
     0xFF,       0xFF,   0xFF,   0xFF,   0xFF,   0xFF,
     0xFF,
-    ]
+    ])
 
-    Lut_partial=[0x67,  0xBF,   0x3F,   0x0D,   0x00,   0x1C,
+    Lut_partial=bytes([0x67,  0xBF,   0x3F,   0x0D,   0x00,   0x1C,
     #VCOM
     0x00,       0x14,   0x02,   0x00,   0x00,   0x01,
     0x00,       0x00,   0x00,   0x00,   0x00,   0x00,
@@ -294,122 +1035,344 @@ class EPD:
     0xFF,       0xFF,   0xFF,   0xFF,   0xFF,   0xFF,
     0xFF,       0xFF,   0xFF,   0xFF,   0xFF,   0xFF,
     0xFF,
-    ]
+    ])
+
+    # Register tables: (command, payload) pairs, each payload goes out in one transfer
+    INIT_POWER_SEQUENCE = (
+        (0x01, bytes([0x17,                     # power setting, 1-0=11: internal power
+                      Voltage_Frame_7IN5_V2[6], # VGH&VGL
+                      Voltage_Frame_7IN5_V2[1], # VSH
+                      Voltage_Frame_7IN5_V2[2], # VSL
+                      Voltage_Frame_7IN5_V2[3]])), # VSHR
+        (0x82, bytes([Voltage_Frame_7IN5_V2[4]])),  # VCOM DC Setting
+        (0x06, bytes([0x27, 0x27, 0x2F, 0x17])),    # Booster Setting
+        (0x30, bytes([Voltage_Frame_7IN5_V2[0]])),  # OSC Setting, 3C=50Hz, 3A=100HZ
+    )
+
+    INIT_PANEL_SEQUENCE = (
+        (0x00, bytes([0x3F])),                  # PANNEL SETTING, KW-3f KWR-2F BWROTP-0f BWOTP-1f
+        (0x61, bytes([0x03, 0x20, 0x01, 0xE0])),    # tres, source 800, gate 480
+        (0x15, bytes([0x00])),
+        (0x50, bytes([0x10, 0x07])),            # VCOM AND DATA INTERVAL SETTING
+        (0x60, bytes([0x22])),                  # TCON SETTING
+        (0x65, bytes([0x00, 0x00, 0x00, 0x00])),    # Resolution setting, 800*480
+    )
+
+    INIT2_SEQUENCE = (
+        (0x00, bytes([0x3F])),                  # Panel setting
+        (0x06, bytes([0x17, 0x17, 0x28, 0x18])),    # Booster Setting
+        (0x50, bytes([0x22, 0x07])),            # VCOM and DATA interval setting
+        (0x60, bytes([0x22])),                  # TCON setting, S-G G-S
+        (0x61, bytes([0x03, 0x20, 0x01, 0xE0])),    # Resolution setting, 800*480
+        (0x65, bytes([0x00, 0x00, 0x00, 0x00])),    # Resolution setting
+    )
+
+    # UD (gate scan up) and SHL (source shift right) bits of the panel setting;
+    # clearing both turns the scan around, i.e. rotates the picture by 180
+    PSR_SCAN_BITS = 0x0C
+
+    @property
+    def orientation(self):
+        return self._orientation
+
+    @orientation.setter
+    def orientation(self, degrees):
+        # Degrees the panel is mounted turned clockwise from landscape (the
+        # picture is drawn turned the other way so it reads upright). 180 and 270 get
+        # the controller to scan backwards (panel setting 0x00) instead of
+        # rotating pixels; 90 and 270 transpose the canvas once while packing.
+        if degrees not in (0, 90, 180, 270):
+            raise ValueError("orientation must be 0, 90, 180 or 270, got %r" % (degrees,))
+        with self._lock:
+            self._orientation = degrees
+            if self._awake and 0x00 in self._registers:
+                # rewrite the panel setting right away, the next refresh uses it
+                self._send_sequence(self._oriented(((0x00, self._registers[0x00]),)))
+
+    @property
+    def size(self):
+        # logical canvas size for the current orientation
+        if self._orientation in (90, 270):
+            return (self.height, self.width)
+        return (self.width, self.height)
+
+    def _oriented(self, sequence):
+        # the panel setting with the scan direction for the current orientation
+        flip = self._orientation in (180, 270)
+        result = []
+        for command, payload in sequence:
+            if command == 0x00:
+                value = payload[0] & ~self.PSR_SCAN_BITS if flip else payload[0] | self.PSR_SCAN_BITS
+                payload = bytes([value]) + bytes(payload[1:])
+            result.append((command, payload))
+        return result
+
+    def _to_panel(self, x, y, w, h):
+        # logical rectangle -> controller RAM rectangle (x, y, w, h); RAM is
+        # the canvas turned 90 degrees counter-clockwise for 90/270, as is
+        if self._orientation in (90, 270):
+            return (y, self.height - x - w, h, w)
+        return (x, y, w, h)
+
+    # timing helpers: _tick() is None while stats are disabled
+    def _tick(self):
+        return time.perf_counter() if self.stats.enabled else None
+
+    def _tock(self, phase, start):
+        if start is not None:
+            self.stats.add_phase(phase, time.perf_counter() - start)
 
     # Hardware reset
     def reset(self):
-        digital_write(self.reset_pin, 1)
-        delay_ms(20) 
-        digital_write(self.reset_pin, 0)
-        delay_ms(2)
-        digital_write(self.reset_pin, 1)
-        delay_ms(20)   
+        start = self._tick()
+        self.backend.digital_write(self.reset_pin, 1)
+        self.backend.delay_ms(20) 
+        self.backend.digital_write(self.reset_pin, 0)
+        self.backend.delay_ms(2)
+        self.backend.digital_write(self.reset_pin, 1)
+        self.backend.delay_ms(20)   
+        self._partial = False
+        self._awake = True
+        self._powered = False
+        self.mode = None
+        self._registers.clear()
+        self._tock('reset', start)
+
+    # CS is driven by the SPI controller, so only DC needs toggling, and only
+    # when it changes between command and data phases.
+    def _set_dc(self, value):
+        if self._dc_state != value:
+            self.backend.digital_write(self.dc_pin, value)
+            self._dc_state = value
 
     def send_command(self, command):
-        digital_write(self.dc_pin, 0)
-        digital_write(self.cs_pin, 0)
-        spi_writebyte([command])
-        digital_write(self.cs_pin, 1)
+        self._set_dc(0)
+        self.backend.spi_writebyte([command])
+        self._command = command
+        if self.stats.enabled:
+            self.stats.add_spi(command, 1)
 
     def send_data(self, data):
-        digital_write(self.dc_pin, 1)
-        digital_write(self.cs_pin, 0)
-        spi_writebyte([data])
-        digital_write(self.cs_pin, 1)
+        self._set_dc(1)
+        self.backend.spi_writebyte([data])
+        if self.stats.enabled:
+            self.stats.add_spi(self._command, 1)
 
     def send_data2(self, data):
-        digital_write(self.dc_pin, 1)
-        digital_write(self.cs_pin, 0)
-        spi_writebyte2(data)
-        digital_write(self.cs_pin, 1)
+        self._set_dc(1)
+        self.backend.spi_writebyte2(data)
+        if self.stats.enabled:
+            self.stats.add_spi(self._command, len(data))
+
+    def _send_sequence(self, sequence):
+        # Registers already holding the payload are skipped. Returns the set of
+        # commands actually sent.
+        sent = set()
+        registers = self._registers
+        for command, payload in sequence:
+            if payload:
+                if registers.get(command) == payload:
+                    continue
+                self.send_command(command)
+                self.send_data2(payload)
+                registers[command] = bytes(payload)
+            else:
+                self.send_command(command)
+            sent.add(command)
+        return sent
 
-    def ReadBusy(self):
-        logger.debug("e-Paper busy")
-        self.send_command(0x71)
-        busy = digital_read(self.busy_pin)
-        while(busy == 0):
-            self.send_command(0x71)
-            busy = digital_read(self.busy_pin)
-        delay_ms(20)
-        logger.debug("e-Paper busy release")
-        
-    def SetLut(self, lut_vcom, lut_ww, lut_bw, lut_wb, lut_bb):
-        self.send_command(0x20)
-        for count in range(0, 42):
-            self.send_data(lut_vcom[count])
+    # the booster soft-start setting only takes effect at power on
+    POWER_REGISTERS = {0x06}
 
-        self.send_command(0x21)
-        for count in range(0, 42):
-            self.send_data(lut_ww[count])
+    def _power_on(self):
+        start = self._tick()
+        self.send_command(0x04)     # POWER ON
+        self.backend.delay_ms(100)
+        self.ReadBusy()
+        self._powered = True
+        self._tock('power_on', start)
+        self._arm_idle()
 
-        self.send_command(0x22)
-        for count in range(0, 42):
-            self.send_data(lut_bw[count])
+    def _power_off(self):
+        start = self._tick()
+        self.send_command(0x02)     # POWER OFF
+        self.ReadBusy()
+        self._powered = False
+        self._tock('power_off', start)
 
-        self.send_command(0x23)
-        for count in range(0, 42):
-            self.send_data(lut_wb[count])
+    def _refresh(self, phase):
+        start = self._tick()
+        self.send_command(0x12)
+        self.backend.delay_ms(100)
+        busy_time = self.ReadBusy()
+        if start is not None:
+            self._tock(phase, start)
+            self.stats.export()
+        self._arm_idle()
+        return busy_time
+
+    def _cancel_idle(self):
+        self._idle_generation += 1
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _arm_idle(self):
+        # restart the idle countdown; a timer that fires after newer activity
+        # sees a changed generation and does nothing
+        self._cancel_idle()
+        if self.idle_power_off is not None:
+            self._schedule_idle(self.idle_power_off, self._idle_power_off)
+        elif self.idle_sleep is not None:
+            self._schedule_idle(self.idle_sleep, self._idle_sleep)
+
+    def _schedule_idle(self, delay, action):
+        timer = threading.Timer(delay, self._idle_fire, (self._idle_generation, action))
+        timer.daemon = True
+        self._idle_timer = timer
+        timer.start()
+
+    def _idle_fire(self, generation, action):
+        with self._lock:
+            if generation != self._idle_generation:
+                return
+            try:
+                action()
+            except Exception:
+                logger.exception("idle %s failed", action.__name__)
+
+    def _idle_power_off(self):
+        if self._awake and self._powered:
+            logger.debug("idle: power off")
+            self._power_off()
+        if self.idle_sleep is not None:
+            self._schedule_idle(max(self.idle_sleep - self.idle_power_off, 0), self._idle_sleep)
+
+    def _idle_sleep(self):
+        if self._awake:
+            logger.debug("idle: deep sleep")
+            self.sleep()
+
+    def _lost_spi(self):
+        # SPI closed outside this EPD (the module-level module_exit()): the
+        # panel lost power too, so it needs a reset and the full register set
+        if self.backend.spi_open:
+            return False
+        if self._awake:
+            self._resume_mode = self.mode
+        self._awake = False
+        self._dc_state = None
+        return True
+
+    def _resume(self):
+        # before a refresh: undo an idle power off or deep sleep
+        self._lost_spi()
+        if not self._awake:
+            if self._resume_mode is not None:
+                logger.debug("waking from deep sleep into %s mode", self._resume_mode)
+                {'full': self.init, 'fast': self.init_fast, 'partial': self.init_part}[self._resume_mode]()
+        elif not self._powered:
+            self._power_on()
+
+    def _wake(self):
+        # module_init (a no-op while SPI is open) and a hardware reset, unless
+        # the panel is already out of reset
+        self._lost_spi()
+        # a deep sleep still waiting to close SPI: keep it open
+        self._sleep_pending = None
+        if (self.backend.module_init() != 0):
+            return -1
+        if self._awake:
+            return 0
+        self.reset()
+        return 0
 
-        self.send_command(0x24)
-        for count in range(0, 42):
-            self.send_data(lut_bb[count])
+    @_locked
+    def invalidate(self):
+        # Forget the tracked controller state after a BUSY timeout or anything
+        # else that may have left the panel stuck or garbled: the next init
+        # does a hardware reset and sends every register again, and a refresh
+        # re-inits into the current mode first.
+        if self._awake:
+            self._resume_mode = self.mode
+        self._awake = False
+        self._powered = False
+        self.mode = None
+        self._registers.clear()
+        self._last_frame = None
+        self._dc_state = None
+
+    def _apply_power_sequence(self, sequence):
+        sent = self._send_sequence(sequence)
+        if self._powered and sent & self.POWER_REGISTERS:
+            self._power_off()
+        if not self._powered:
+            self._power_on()
+
+    def ReadBusy(self, timeout=None):
+        if timeout is None:
+            timeout = self.busy_timeout
+        logger.debug("e-Paper busy")
+        start = time.monotonic()
+        self.send_command(0x71)
+        if self.backend.digital_read(self.busy_pin) == 0:
+            if self.busy_poll or not hasattr(self.backend, 'busy_wait'):
+                released = self._poll_busy(start, timeout)
+            else:
+                released = self.backend.busy_wait(timeout)
+            if not released:
+                self.invalidate()
+                raise BusyTimeoutError("e-Paper still busy after %.1f s" % (time.monotonic() - start))
+        busy_time = time.monotonic() - start
+        if self.stats.enabled:
+            self.stats.add_busy_wait()
+        self.backend.delay_ms(20)
+        logger.debug("e-Paper busy release after %.3f s", busy_time)
+        return busy_time
+
+    def _poll_busy(self, start, timeout):
+        # adaptive backoff: 1 ms doubling up to 50 ms between status polls
+        interval = 0.001
+        while True:
+            if timeout is not None and time.monotonic() - start > timeout:
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, 0.05)
+            if self.stats.enabled:
+                self.stats.add_busy_poll()
+            self.send_command(0x71)
+            if self.backend.digital_read(self.busy_pin) != 0:
+                return True
 
+    def SetLut(self, lut_vcom, lut_ww, lut_bw, lut_wb, lut_bb):
+        start = self._tick()
+        self._send_sequence((
+            (0x20, bytes(lut_vcom[:42])),
+            (0x21, bytes(lut_ww[:42])),
+            (0x22, bytes(lut_bw[:42])),
+            (0x23, bytes(lut_wb[:42])),
+            (0x24, bytes(lut_bb[:42])),
+        ))
+        self._tock('lut_upload', start)
+
+    @_locked
     def init(self):
-        if (module_init() != 0):
+        # Only the reset, power cycle and registers that differ from the current
+        # controller state are sent, so re-running init in the same mode is cheap.
+        start = self._tick()
+        if (self._wake() != 0):
             return -1
         # EPD hardware init start
-        self.reset()
-
-        self.send_command(0x01)     # power setting
-        self.send_data(0x17)        # 1-0=11: internal power
-        self.send_data(self.Voltage_Frame_7IN5_V2[6])   # VGH&VGL
-        self.send_data(self.Voltage_Frame_7IN5_V2[1])   # VSH
-        self.send_data(self.Voltage_Frame_7IN5_V2[2])   # VSL
-        self.send_data(self.Voltage_Frame_7IN5_V2[3])   # VSHR
-        
-        self.send_command(0x82)     # VCOM DC Setting
-        self.send_data(self.Voltage_Frame_7IN5_V2[4])   # VCOM
-
-        self.send_command(0x06)     # Booster Setting
-        self.send_data(0x27)
-        self.send_data(0x27)
-        self.send_data(0x2F)
-        self.send_data(0x17)
-        
-        self.send_command(0x30)     # OSC Setting
-        self.send_data(self.Voltage_Frame_7IN5_V2[0])   # 3C=50Hz, 3A=100HZ
-
-        self.send_command(0x04)     # POWER ON
-        delay_ms(100)
-        self.ReadBusy()
-
-        self.send_command(0X00)     # PANNEL SETTING
-        self.send_data(0x3F)        # KW-3f KWR-2F BWROTP-0f BWOTP-1f
-
-        self.send_command(0x61)     # tres
-        self.send_data(0x03)        # source 800
-        self.send_data(0x20)
-        self.send_data(0x01)        # gate 480
-        self.send_data(0xE0)
-
-        self.send_command(0X15)
-        self.send_data(0x00)
-
-        self.send_command(0X50)     # VCOM AND DATA INTERVAL SETTING
-        self.send_data(0x10)
-        self.send_data(0x07)
-
-        self.send_command(0X60)     # TCON SETTING
-        self.send_data(0x22)
-
-        self.send_command(0x65)     # Resolution setting
-        self.send_data(0x00)
-        self.send_data(0x00)        # 800*480
-        self.send_data(0x00)
-        self.send_data(0x00)
+        if self._partial:
+            self._leave_partial()
+        self._apply_power_sequence(self.INIT_POWER_SEQUENCE)
+        self._send_sequence(self._oriented(self.INIT_PANEL_SEQUENCE))
+        self._cdi = dict(self.INIT_PANEL_SEQUENCE)[0x50]
 
         self.SetLut(self.LUT_VCOM_7IN5_V2, self.LUT_WW_7IN5_V2, self.LUT_BW_7IN5_V2, self.LUT_WB_7IN5_V2, self.LUT_BB_7IN5_V2)
+        self.mode = 'full'
         # EPD hardware init end
+        self._tock('init', start)
         return 0
     
     def Epaper_LUT_By_MCU(self,wavedata):
@@ -420,195 +1383,426 @@ class EPD:
         PLL=(wavedata[0]&0xF0)>>4
         XON=wavedata[2]&0xC0
 
-        self.send_command(0x52)       #EVS
-        self.send_data(EVS)
-
-        self.send_command(0x30)                   #PLL setting 
-        self.send_data(PLL)
-
-        self.send_command(0x01)       #Set VGH VGL VSH VSL VSHR
-        self.send_data (0x17)
-        self.send_data (wavedata[0]&0x07)       #VGH/VGL Voltage Level selection
-        self.send_data (wavedata[1]&0x3F)               #VSH for black
-        self.send_data (wavedata[2]&0x3F)       #VSL for white
-        self.send_data (wavedata[3]&0x3F)       #VSHR for red
-
-        self.send_command(0x2A)       #LUTOPT
-        self.send_data(XON)
-        self.send_data(wavedata[4])
-
-        self.send_command(0x82)       #VCOM_DC setting
-        self.send_data (wavedata[5])  #Vcom value
-
-
-        self.send_command(0x20)
-        self.send_data2(wavedata[6:48])
-
-        self.send_command(0x21)
-        self.send_data2(wavedata[48:90])
-
-        self.send_command(0x22)
-        self.send_data2(wavedata[90:132])
-
-        self.send_command(0x23)
-        self.send_data2(wavedata[132:174])
-
-        self.send_command(0x24)
-        self.send_data2(wavedata[174:216])
+        start = self._tick()
+        self._send_sequence((
+            (0x52, bytes([EVS])),           #EVS
+            (0x30, bytes([PLL])),           #PLL setting
+            (0x01, bytes([0x17,             #Set VGH VGL VSH VSL VSHR
+                          wavedata[0]&0x07, #VGH/VGL Voltage Level selection
+                          wavedata[1]&0x3F, #VSH for black
+                          wavedata[2]&0x3F, #VSL for white
+                          wavedata[3]&0x3F])),  #VSHR for red
+            (0x2A, bytes([XON, wavedata[4]])),  #LUTOPT
+            (0x82, bytes([wavedata[5]])),   #VCOM_DC setting, Vcom value
+            (0x20, bytes(wavedata[6:48])),
+            (0x21, bytes(wavedata[48:90])),
+            (0x22, bytes(wavedata[90:132])),
+            (0x23, bytes(wavedata[132:174])),
+            (0x24, bytes(wavedata[174:216])),
+        ))
+        self._tock('lut_upload', start)
 
     def init2(self):
-        if (module_init() != 0):
+        if (self._wake() != 0):
             return -1
         # EPD hardware init start
-        self.reset()
-
-        self.send_command(0x00)  # Panel setting   
-        self.send_data(0x3F)
-
-        self.send_command(0x06)  # Booster Setting
-        self.send_data(0x17)  
-        self.send_data(0x17)
-        self.send_data(0x28)
-        self.send_data(0x18)
-
-        self.send_command(0x50)  # VCOM and DATA interval setting    
-        self.send_data(0x22)
-        self.send_data(0x07)
-
-        self.send_command(0x60)  # TCON setting
-        self.send_data(0x22)  # S-G G-S
-
-        self.send_command(0x61)  # Resolution setting
-        self.send_data(0x03)#800*480
-        self.send_data(0x20)
-        self.send_data(0x01)
-        self.send_data(0xE0) 
-
-        self.send_command(0x65)  # Resolution setting
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-
-        self.send_command(0x04) #POWER ON
-        delay_ms(100)
-        self.ReadBusy() 
+        if self._partial:
+            self._leave_partial()
+        self._cdi = dict(self.INIT2_SEQUENCE)[0x50]
+        self._apply_power_sequence(self._oriented(self.INIT2_SEQUENCE))
 
         return 0
 
+    @_locked
     def init_fast(self):
-        self.init2()
+        start = self._tick()
+        if (self.init2() != 0):
+            return -1
         self.Epaper_LUT_By_MCU(self.Lut_all_fresh)
+        self.mode = 'fast'
+        self._tock('init', start)
         return 0
     
 
+    @_locked
     def init_part(self):
-        self.init2()
+        start = self._tick()
+        if (self.init2() != 0):
+            return -1
         self.Epaper_LUT_By_MCU(self.Lut_partial)
+        self.mode = 'partial'
+        self._tock('init', start)
         return 0
     
 
-    def getbuffer(self, image):
+    def load_image(self, source, size=None, mode='L'):
+        # see load_image(), sized for the current orientation by default
+        return load_image(source, size or self.size, mode)
+
+    def getbuffer(self, image, out=None, dither=None):
+        # dither: a dither.METHODS name for greyscale/colour images, PIL's
+        # Floyd-Steinberg conversion when None
+        # A portrait (height x width) canvas is turned into RAM order with one
+        # transpose of the 1-bit image; 180 degrees cost nothing here since the
+        # controller scans backwards instead (see orientation).
         img = image
         imwidth, imheight = img.size
+        transpose = False
         if(imwidth == self.width and imheight == self.height):
-            img = img.convert('1')
+            pass
         elif(imwidth == self.height and imheight == self.width):
             # image has correct dimensions, but needs to be rotated
-            img = img.rotate(90, expand=True).convert('1')
+            transpose = True
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
+            if out is None:
+                return bytearray(self.width // 8 * self.height)
+            out[:] = bytes(len(out))
+            return out
+        if img.mode != '1':
+            if dither is None:
+                img = img.convert('1')
+            else:
+                import dither as dithering
+                img = dithering.dither(img, dither)
+        if transpose:
+            from PIL import Image
+            img = img.transpose(Image.ROTATE_90)
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
-        # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        # in the e-paper world 0=white and 1=black. The '1;I' raw packer does the inversion
+        # while packing, so the frame is produced in a single pass in C.
+        # tobytes() always builds a new bytes object: out spares the caller a
+        # new bytearray per frame, not that allocation.
+        packed = img.tobytes('raw', '1;I')
+        if out is None:
+            return bytearray(packed)
+        if len(out) != len(packed):
+            raise ValueError("Output buffer must be %d bytes, got %d" % (len(packed), len(out)))
+        out[:] = packed
+        return out
+
+    def _frame(self, image):
+        # accept bytes, bytearray, memoryview or anything else exposing a buffer
+        try:
+            frame = memoryview(image).cast('B')
+        except TypeError:
+            frame = memoryview(bytes(image))
+        if len(frame) != self.frame_size:
+            raise ValueError("Frame must be %d bytes, got %d" % (self.frame_size, len(frame)))
+        return frame
+
+    def _leave_partial(self):
+        self.send_command(0x92)     # partial out
+        if self._cdi is not None:
+            self._send_sequence(((0x50, self._cdi),))
+        self._partial = False
+
+    def _remember(self, frame):
+        if self._last_frame is None:
+            self._last_frame = bytearray(frame)
+        else:
+            self._last_frame[:] = frame
 
+    @_locked
     def display(self, image):
-        if(self.width % 8 == 0):
-            Width = self.width // 8
-        else:
-            Width = self.width // 8 +1
-        Height = self.height
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~image[i + j * Width]
+        frame = self._frame(image)
+        self._resume()
+        if self._partial:
+            self._leave_partial()
+        # One copy into _last_frame (also when the frame is a memoryview of a
+        # mapped FrameStore), and the new-data plane is sent from it, so the
+        # backend always gets a plain bytearray. The old-data plane is its
+        # inverse; translate() always returns a new object, and there is no
+        # in-place byte inversion without NumPy, so that is the one allocation.
+        self._remember(frame)
+        old_plane = self._last_frame.translate(INVERT_TABLE)
+
+        start = self._tick()
         self.send_command(0x10)
-        self.send_data2(image1)
+        self.send_data2(old_plane)
 
         self.send_command(0x13)
-        self.send_data2(image)
+        self.send_data2(self._last_frame)
+        self._tock('transfer', start)
 
-        self.send_command(0x12)
-        delay_ms(100)
-        self.ReadBusy()
+        self._refresh('refresh_full')
 
+    @_locked
     def Clear(self):
+        self._resume()
+        if self._partial:
+            self._leave_partial()
+        start = self._tick()
         self.send_command(0x10)
-        self.send_data2([0xFF] * int(self.width * self.height / 8))
+        self.send_data2(self._white_plane)
         self.send_command(0x13)
-        self.send_data2([0x00] * int(self.width * self.height / 8))
-        self.send_command(0x12)
-        delay_ms(100)
-        self.ReadBusy()
+        self.send_data2(self._black_plane)
+        self._tock('transfer', start)
+        self._remember(self._black_plane)
+        self._refresh('refresh_full')
 
+    @_locked
     def display_Partial(self, Image, Xstart, Ystart, Xend, Yend):
-        if((Xstart % 8 + Xend % 8 == 8 & Xstart % 8 > Xend % 8) | Xstart % 8 + Xend % 8 == 0 | (Xend - Xstart)%8 == 0):
-            Xstart = Xstart // 8 * 8
-            Xend = Xend // 8 * 8
-        else:
-            Xstart = Xstart // 8 * 8
-            if Xend % 8 == 0:
-                Xend = Xend // 8 * 8
-            else:
-                Xend = Xend // 8 * 8 + 1
-                
+        # Image is either a full packed frame, or just the packed window: rows of
+        # (Xend - Xstart) / 8 bytes. X is widened to whole bytes, so a window on
+        # its own must already be aligned; display_Region pads unaligned ones.
+        aligned = Xstart % 8 == 0 and Xend % 8 == 0
+        Xstart = max(Xstart, 0) // 8 * 8
+        Xend = min((Xend + 7) // 8 * 8, self.width)
+        Ystart = max(Ystart, 0)
+        Yend = min(Yend, self.height)
         Width = (Xend - Xstart) // 8
         Height = Yend - Ystart
-
-        self.send_command(0x50)
-        self.send_data(0xA9)
-        self.send_data(0x07)
-
-        self.send_command(0x91)         # This command makes the display enter partial mode
-        self.send_command(0x90)         # resolution setting
-        self.send_data (Xstart//256)
-        self.send_data (Xstart%256)   #x-start    
-
-        self.send_data ((Xend-1)//256)
-        self.send_data ((Xend-1)%256)  #x-end
-
-        self.send_data (Ystart//256)  #
-        self.send_data (Ystart%256)   #y-start    
-
-        self.send_data ((Yend-1)//256)
-        self.send_data ((Yend-1)%256)  #y-end
-        self.send_data (0x01)
-
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~Image[i + j * Width]
-
+        if Width <= 0 or Height <= 0:
+            raise ValueError("Empty partial window")
+
+        try:
+            data = memoryview(Image).cast('B')
+        except TypeError:
+            data = memoryview(bytes(Image))
+        if len(data) == self.frame_size:
+            window = self._window_bytes(data, Xstart, Ystart, Xend, Yend)
+        elif len(data) == Width * Height:
+            if not aligned:
+                raise ValueError("Partial window data needs Xstart and Xend on multiples of 8, "
+                                 "use display_Region for unaligned rectangles")
+            window = data.tobytes()
+        else:
+            raise ValueError("Partial data must be a full frame or %d bytes for a %dx%d window, got %d"
+                             % (Width * Height, Xend - Xstart, Height, len(data)))
+
+        self._resume()
+        self._send_sequence((
+            (0x50, bytes([0xA9, 0x07])),
+            (0x91, None),               # This command makes the display enter partial mode
+            (0x90, bytes([Xstart//256, Xstart%256,          # resolution setting, x-start
+                          (Xend-1)//256, (Xend-1)%256,      # x-end
+                          Ystart//256, Ystart%256,          # y-start
+                          (Yend-1)//256, (Yend-1)%256,      # y-end
+                          0x01])),
+        ))
+
+        start = self._tick()
         self.send_command(0x13)   #Write Black and White image to RAM
-        self.send_data2(image1)
-
-        self.send_command(0x12)
-        delay_ms(100)
-        self.ReadBusy()
+        self.send_data2(window.translate(INVERT_TABLE))
+        self._tock('transfer', start)
+        self._partial = True
+
+        if self._last_frame is not None:
+            row = self.width // 8
+            for j in range(Height):
+                start = (Ystart + j) * row + Xstart // 8
+                self._last_frame[start:start + Width] = window[j * Width:(j + 1) * Width]
+
+        self._refresh('refresh_partial')
+
+    @_locked
+    def display_Region(self, image, x, y):
+        # Partial refresh of a PIL image placed at (x, y). When x or the width is
+        # not a multiple of 8 the window is widened to whole bytes and the extra
+        # pixels are taken from the last frame (white if there is none).
+        # x and y are canvas coordinates for the current orientation.
+        if self._orientation in (90, 270):
+            from PIL import Image
+            if image.mode != '1':
+                image = image.convert('1')
+            x, y, _, _ = self._to_panel(x, y, *image.size)
+            image = image.transpose(Image.ROTATE_90)
+        w, h = image.size
+        Xstart = x // 8 * 8
+        Xend = min((x + w + 7) // 8 * 8, self.width)
+        if image.mode != '1':
+            image = image.convert('1')
+        if Xstart != x or Xend != x + w:
+            from PIL import Image
+            if self._last_frame is not None:
+                base = Image.frombytes('1', (Xend - Xstart, h),
+                                       self._window_bytes(self._last_frame, Xstart, y, Xend, y + h),
+                                       'raw', '1;I')
+            else:
+                base = Image.new('1', (Xend - Xstart, h), 255)
+            base.paste(image, (x - Xstart, 0))
+            image = base
+        self.display_Partial(image.tobytes('raw', '1;I'), Xstart, y, Xend, y + h)
+
+    def _changed_window(self, frame):
+        # Byte-aligned bounding box (Xstart, Ystart, Xend, Yend) of the pixels that
+        # differ from the last frame, or None when nothing changed.
+        new = frame.tobytes()
+        old = self._last_frame
+        if new == old:
+            return None
+        row = self.width // 8
+        top = 0
+        while new[top * row:(top + 1) * row] == old[top * row:(top + 1) * row]:
+            top += 1
+        bottom = self.height
+        while new[(bottom - 1) * row:bottom * row] == old[(bottom - 1) * row:bottom * row]:
+            bottom -= 1
+
+        # OR together the per-row differences, then read the outermost set bits
+        diff = 0
+        for y in range(top, bottom):
+            diff |= (int.from_bytes(new[y * row:(y + 1) * row], 'big')
+                     ^ int.from_bytes(old[y * row:(y + 1) * row], 'big'))
+        left = row - 1 - (diff.bit_length() - 1) // 8
+        right = row - ((diff & -diff).bit_length() - 1) // 8
+        return left * 8, top, right * 8, bottom
+
+    def _window_bytes(self, frame, Xstart, Ystart, Xend, Yend):
+        row = self.width // 8
+        x0 = Xstart // 8
+        x1 = Xend // 8
+        return b''.join(frame[y * row + x0:y * row + x1] for y in range(Ystart, Yend))
+
+    @_locked
+    def changed_window(self, image):
+        # The window display_auto would refresh for image: None when nothing
+        # changed, the whole panel when no frame has been pushed yet.
+        frame = self._frame(image)
+        if self._last_frame is None:
+            return 0, 0, self.width, self.height
+        return self._changed_window(frame)
+
+    @_locked
+    def display_auto(self, image, threshold=None):
+        # Push only what changed since the last frame: nothing, a partial window,
+        # or a full refresh when the changed area is above the threshold.
+        # Returns None, 'partial' or 'full'.
+        if threshold is None:
+            threshold = self.partial_threshold
+        frame = self._frame(image)
+        if self._last_frame is None:
+            self.display(frame)
+            return 'full'
+        window = self._changed_window(frame)
+        if window is None:
+            logger.debug("frame unchanged, refresh skipped")
+            return None
+        Xstart, Ystart, Xend, Yend = window
+        if (Xend - Xstart) * (Yend - Ystart) > threshold * self.width * self.height:
+            self.display(frame)
+            return 'full'
+        logger.debug("partial refresh of %s", window)
+        self.display_Partial(self._window_bytes(frame, *window), *window)
+        return 'partial'
+
+    @_locked
+    def sleep(self, wait=False):
+        # Deep sleep. SPI and the panel power are shut 2 s later on a
+        # background (non-daemon) thread unless wait is true; a refresh in
+        # between cancels that and wakes the panel again.
+        self._cancel_idle()
+        if not self._awake:
+            if self._sleep_pending is None:
+                # already asleep (or never woken by this EPD): SPI is closed, just cut the power
+                self.backend.module_exit()
+                self._dc_state = None
+            return
+        if self._powered:
+            self._power_off()
 
-    def sleep(self):
-        self.send_command(0x02) # POWER_OFF
-        self.ReadBusy()
-        
         self.send_command(0x07) # DEEP_SLEEP
         self.send_data(0XA5)
-        
-        delay_ms(2000)
-        module_exit()
-
+        # only a hardware reset wakes the controller, and it forgets its
+        # registers and RAM, so the next frame goes out as a full refresh
+        self._awake = False
+        self._resume_mode = self.mode
+        self.mode = None
+        self._registers.clear()
+        self._last_frame = None
+
+        token = self._sleep_pending = object()
+        if wait:
+            self.backend.delay_ms(2000)
+            self._finish_sleep(token)
+        else:
+            threading.Thread(target=self._finish_sleep_later, args=(token,), name='epd-sleep').start()
+
+    def _finish_sleep_later(self, token):
+        self.backend.delay_ms(2000)
+        with self._lock:
+            self._finish_sleep(token)
+
+    def _finish_sleep(self, token):
+        if self._sleep_pending is not token:
+            return
+        self._sleep_pending = None
+        self.backend.module_exit()
+        self._dc_state = None
+
+def _loopback_ok(backend, chunk_size):
+    # needs a MOSI-MISO jumper: every pattern must come back unchanged
+    patterns = [bytes([value]) * chunk_size for value in (0x00, 0xFF, 0x55, 0xAA)]
+    patterns.append(bytes(i & 0xFF for i in range(chunk_size)))
+    patterns.append(os.urandom(chunk_size))
+    for pattern in patterns:
+        if backend.spi_transfer(pattern) != pattern:
+            return False
+    return True
+
+def calibrate_spi(epd, speeds=SPI_SPEEDS, method='refresh', rounds=2, save=True, path=None):
+    # Step through rising SPI clocks and return the highest one that passes
+    # every round (stopping at the first failure), saved for this board model.
+    #   loopback: write/read back test patterns, needs MISO wired to MOSI
+    #   refresh:  drive the panel and check that each refresh really happens,
+    #             i.e. BUSY does not time out and stays low for at least half
+    #             as long as at the slowest clock; a garbled 0x12 never
+    #             starts a refresh
+    if method not in ('loopback', 'refresh'):
+        raise ValueError("method must be 'loopback' or 'refresh'")
+    backend = epd.backend
+    if getattr(backend, 'set_speed', None) is None:
+        raise RuntimeError("backend %r has no adjustable SPI clock" % type(backend).__name__)
+    original = backend.spi_speed
+    speeds = sorted(speeds)
+    best = None
+    reference = None
+    try:
+        if method == 'refresh':
+            backend.set_speed(speeds[0])
+            epd.init()
+            checker = bytearray(epd.frame_size)
+            for row in range(epd.height):
+                start = row * (epd.width // 8)
+                checker[start:start + epd.width // 8] = (b'\xF0\x0F' if row & 8 else b'\x0F\xF0') * (epd.width // 16)
+            frames = (bytes(checker), bytes(checker).translate(INVERT_TABLE))
+        else:
+            epd.backend.module_init()
+            chunk_size = min(getattr(backend, 'chunk_size', 4096), 4096)
+
+        for speed in speeds:
+            backend.set_speed(speed)
+            ok = True
+            for n in range(rounds):
+                if method == 'loopback':
+                    ok = _loopback_ok(backend, chunk_size)
+                else:
+                    epd.send_command(0x13)
+                    epd.send_data2(frames[n % 2])
+                    try:
+                        busy = epd._refresh('calibrate')
+                    except BusyTimeoutError:
+                        ok = False
+                    else:
+                        if reference is None:
+                            reference = busy
+                        ok = busy >= reference * 0.5
+                if not ok:
+                    break
+            logger.info("SPI %d Hz: %s", speed, 'ok' if ok else 'failed')
+            if not ok:
+                break
+            best = speed
+    finally:
+        backend.set_speed(best or original)
+        if method == 'refresh':
+            # the panel may have seen garbage, start again from a clean reset
+            epd.invalidate()
+            epd.init()
+            epd.Clear()
+    if best is not None and save:
+        save_spi_calibration(best, method, path)
+    return best
@@ -0,0 +1,103 @@
+# Several panels driven from one host.
+#
+# Each EPD gets its own backend (pins and SPI device, see RaspberryPi) and its
+# own worker thread. A call on the MultiPanel runs on every panel at once and
+# returns when all of them are done, so the data transfers and the seconds-long
+# BUSY periods overlap and a wall of N panels refreshes in about the time of
+# one. The BUSY waits block on a GPIO edge and release the GIL, as do the
+# simulator's.
+#
+#     wall = MultiPanel([EPD(RaspberryPi(spi_device=0)),
+#                        EPD(RaspberryPi(spi_device=1, rst_pin=5, dc_pin=6, busy_pin=13))],
+#                       columns=2)
+#     wall.init()
+#     wall.show(big_image)          # 1600x480, split across the two panels
+#
+# With simulated panels: MultiPanel([EPD(SimulatedPanel()) for _ in range(4)], columns=2)
+
+import concurrent.futures
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MultiPanel:
+    def __init__(self, epds, columns=None):
+        self.epds = list(epds)
+        if not self.epds:
+            raise ValueError("MultiPanel needs at least one EPD")
+        # wall layout, row by row; a single row by default
+        self.columns = columns or len(self.epds)
+        self.rows = (len(self.epds) + self.columns - 1) // self.columns
+        self._workers = [concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='epd%d' % i)
+                         for i in range(len(self.epds))]
+
+    @property
+    def size(self):
+        # canvas size of the whole wall, from the first panel's orientation
+        width, height = self.epds[0].size
+        return (width * self.columns, height * self.rows)
+
+    def _each(self, name, args=None):
+        # run epd.<name>(*args[i]) on every panel concurrently; if any fail,
+        # the first error is raised once all of them have finished
+        futures = []
+        for i, (epd, worker) in enumerate(zip(self.epds, self._workers)):
+            call_args = args[i] if args is not None else ()
+            futures.append(worker.submit(getattr(epd, name), *call_args))
+        concurrent.futures.wait(futures)
+        results = []
+        error = None
+        for i, future in enumerate(futures):
+            if future.exception() is not None:
+                logger.error("panel %d: %s failed: %s", i, name, future.exception())
+                error = error or future.exception()
+                results.append(None)
+            else:
+                results.append(future.result())
+        if error is not None:
+            raise error
+        return results
+
+    def _frames(self, frames):
+        if len(frames) != len(self.epds):
+            raise ValueError("need %d frames, got %d" % (len(self.epds), len(frames)))
+        return [(frame,) for frame in frames]
+
+    def init(self, mode='full'):
+        name = {'full': 'init', 'fast': 'init_fast', 'partial': 'init_part'}[mode]
+        return self._each(name)
+
+    def Clear(self):
+        return self._each('Clear')
+
+    def display(self, frames):
+        return self._each('display', self._frames(frames))
+
+    def display_auto(self, frames):
+        return self._each('display_auto', self._frames(frames))
+
+    def sleep(self):
+        return self._each('sleep')
+
+    def split(self, image):
+        # one packed frame per panel from a canvas of the wall size
+        if image.size != self.size:
+            raise ValueError("wall image must be %dx%d, got %dx%d" % (self.size + image.size))
+        frames = []
+        for i, epd in enumerate(self.epds):
+            width, height = epd.size
+            x = i % self.columns * width
+            y = i // self.columns * height
+            frames.append(epd.getbuffer(image.crop((x, y, x + width, y + height))))
+        return frames
+
+    def show(self, image, mode='auto'):
+        frames = self.split(image)
+        if mode == 'auto':
+            return self.display_auto(frames)
+        return self.display(frames)
+
+    def close(self):
+        for worker in self._workers:
+            worker.shutdown(wait=True)
@@ -0,0 +1,97 @@
+# Two-stage render/refresh pipeline around EPD.
+#
+# A render thread turns jobs into packed frames while a transfer thread pushes
+# the previous frame to the panel and waits out its refresh, so the sustained
+# update rate is bounded by max(render, refresh) instead of their sum. Both
+# hand-offs are bounded queues. With policy='latest' a full queue drops its
+# oldest entry so the panel always gets the newest frame; with policy='block'
+# producers wait instead (backpressure all the way back to submit()).
+#
+#     pipe = RenderPipeline(epd, lambda path: compose_frame(path, ...))
+#     pipe.submit('a.jpg'); pipe.submit('b.jpg')
+#     pipe.close()
+
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class RenderPipeline:
+    def __init__(self, epd, render, show=None, depth=1, policy='latest'):
+        if policy not in ('latest', 'block'):
+            raise ValueError("policy must be 'latest' or 'block'")
+        self.epd = epd
+        # render(job) -> PIL image of the panel size, or an already packed frame
+        self.render = render
+        # show(frame) pushes a packed frame, EPD.display by default
+        self.show = show or epd.display
+        self.policy = policy
+
+        self.rendered = 0
+        self.shown = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._jobs = queue.Queue(maxsize=depth)
+        self._frames = queue.Queue(maxsize=depth)
+        self._render_thread = threading.Thread(target=self._render_loop, name='epd-render', daemon=True)
+        self._transfer_thread = threading.Thread(target=self._transfer_loop, name='epd-transfer', daemon=True)
+        self._render_thread.start()
+        self._transfer_thread.start()
+
+    def _put(self, q, item):
+        if self.policy == 'block':
+            q.put(item)
+            return
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def submit(self, job):
+        self._put(self._jobs, job)
+
+    def _render_loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is _STOP:
+                self._frames.put(_STOP)
+                return
+            try:
+                frame = self.render(job)
+                if hasattr(frame, 'mode'):
+                    frame = self.epd.getbuffer(frame)
+            except Exception:
+                logger.exception("render failed for %r", job)
+                self.errors += 1
+                continue
+            self.rendered += 1
+            self._put(self._frames, frame)
+
+    def _transfer_loop(self):
+        while True:
+            frame = self._frames.get()
+            if frame is _STOP:
+                return
+            try:
+                self.show(frame)
+                self.shown += 1
+            except Exception:
+                logger.exception("refresh failed")
+                self.errors += 1
+
+    def close(self, timeout=None):
+        # let everything already submitted drain, then stop both threads
+        self._jobs.put(_STOP)
+        self._render_thread.join(timeout)
+        self._transfer_thread.join(timeout)
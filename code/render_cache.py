@@ -0,0 +1,87 @@
+# On-disk cache of packed 1bpp frames, keyed by the source image identity
+# (path, size and mtime, optionally a content hash) plus the layout parameters.
+# Least recently used entries are evicted once the cache grows past max_bytes.
+
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'epaper')
+
+
+class RenderCache:
+    def __init__(self, directory=None, max_bytes=16 * 1024 * 1024, hash_source=False):
+        self.directory = directory or os.environ.get('EPAPER_CACHE_DIR', DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        # hash the source contents instead of trusting size + mtime
+        self.hash_source = hash_source
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, source, **params):
+        st = os.stat(source)
+        identity = [os.path.abspath(source), st.st_size]
+        if self.hash_source:
+            digest = hashlib.sha1()
+            with open(source, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    digest.update(chunk)
+            identity.append(digest.hexdigest())
+        else:
+            identity.append(st.st_mtime_ns)
+        blob = json.dumps([identity, params], sort_keys=True, default=str)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.frame')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = bytearray(f.read())
+        except FileNotFoundError:
+            return None
+        # mtime doubles as the LRU timestamp
+        os.utime(path)
+        logger.debug("render cache hit %s", key)
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.frame'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug("render cache evicted %s", path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.frame'):
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,133 @@
+# Update scheduler above EPD.
+#
+# Producers call submit() with full packed frames whenever they like. A single
+# worker thread coalesces everything that arrived since the last refresh (the
+# newest frame wins, and since it is diffed against what the panel shows, the
+# changes of all the merged updates are covered), keeps at least min_interval
+# between refreshes and picks the waveform:
+#
+#   partial  small change (<= partial_area of the panel) and fewer than
+#            max_partials partial refreshes since the last full one
+#   fast     larger change, fewer than max_fast fast refreshes since the last full one
+#   full     first frame, a change spanning the whole panel, or the
+#            partial/fast budget is used up (clears ghosting)
+#
+# The panel is only re-initialised when the waveform differs from epd.mode, so
+# inits done outside the scheduler (directly, by the daemon or epd_async) and
+# deep sleeps are taken into account.
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateScheduler:
+    def __init__(self, epd, min_interval=2.0, partial_area=0.15, max_partials=20, max_fast=5):
+        self.epd = epd
+        self.min_interval = min_interval
+        self.partial_area = partial_area
+        self.max_partials = max_partials
+        self.max_fast = max_fast
+
+        self.partials_since_full = 0
+        self.fast_since_full = 0
+        self.submitted = 0
+        self.refreshes = {'full': 0, 'fast': 0, 'partial': 0}
+        self.skipped = 0
+
+        self._pending = None
+        self._last_refresh = None
+        self._idle = True
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='epd-scheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, frame):
+        with self._cond:
+            self._pending = frame
+            self.submitted += 1
+            self._idle = False
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        # wait until every submitted frame has been handled
+        with self._cond:
+            return self._cond.wait_for(lambda: self._idle, timeout)
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def choose_mode(self, window):
+        if window is None:
+            return None
+        # changed_window is the whole panel when nothing has been shown yet
+        if self.epd.mode is None or window == (0, 0, self.epd.width, self.epd.height):
+            return 'full'
+        Xstart, Ystart, Xend, Yend = window
+        area = (Xend - Xstart) * (Yend - Ystart) / float(self.epd.width * self.epd.height)
+        if area <= self.partial_area and self.partials_since_full < self.max_partials:
+            return 'partial'
+        if self.fast_since_full < self.max_fast and self.partials_since_full < self.max_partials:
+            return 'fast'
+        return 'full'
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopping:
+                    self._idle = True
+                    self._cond.notify_all()
+                    self._cond.wait()
+                if self._pending is None:
+                    self._idle = True
+                    self._cond.notify_all()
+                    return
+                # hold off until min_interval has passed, collecting newer frames meanwhile
+                if self._last_refresh is not None:
+                    while not self._stopping:
+                        remaining = self._last_refresh + self.min_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                frame, self._pending = self._pending, None
+            try:
+                self._refresh(frame)
+            except Exception:
+                logger.exception("scheduled refresh failed")
+
+    def _init(self, mode):
+        if mode == self.epd.mode:
+            return
+        if mode == 'full':
+            self.epd.init()
+        elif mode == 'fast':
+            self.epd.init_fast()
+        else:
+            self.epd.init_part()
+
+    def _refresh(self, frame):
+        window = self.epd.changed_window(frame)
+        mode = self.choose_mode(window)
+        if mode is None:
+            self.skipped += 1
+            return
+        logger.debug("%s refresh of %s", mode, window)
+        self._init(mode)
+        if mode == 'partial':
+            self.epd.display_Partial(frame, *window)
+            self.partials_since_full += 1
+        else:
+            self.epd.display(frame)
+            if mode == 'full':
+                self.partials_since_full = 0
+                self.fast_since_full = 0
+            else:
+                self.fast_since_full += 1
+        self.refreshes[mode] += 1
+        self._last_refresh = time.monotonic()
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Find the fastest reliable SPI clock for this board and save it, so that
+# RaspberryPi() uses it from then on (EPAPER_SPI_HZ still overrides it).
+#
+# usage: python3 spi_calibrate.py [--method refresh|loopback] [--rounds N]
+#                                 [--speeds 4000000,8000000,...] [--no-save]
+#
+# 'refresh' drives the panel (it flickers through a few checkerboards and is
+# cleared at the end); 'loopback' needs MISO wired to MOSI instead of the panel.
+
+import argparse
+import logging
+import sys
+
+import local_epaper_fns
+from local_epaper_fns import EPD, calibrate_spi
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SPI clock calibration")
+    parser.add_argument('--method', default='refresh', choices=['refresh', 'loopback'])
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--speeds', default=None, help="comma separated clocks in Hz")
+    parser.add_argument('--backend', default=None, help="sim or rpi")
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    speeds = local_epaper_fns.SPI_SPEEDS
+    if args.speeds:
+        speeds = [int(s) for s in args.speeds.split(',')]
+    epd = EPD(args.backend)
+    best = calibrate_spi(epd, speeds, args.method, args.rounds, save=not args.no_save)
+    epd.sleep()
+    if best is None:
+        print("no clock passed, keeping %d Hz" % local_epaper_fns.SPI_SPEED_HZ)
+        sys.exit(1)
+    print("%s: %d Hz%s" % (local_epaper_fns.board_model(), best,
+                           '' if args.no_save else ", saved to " + local_epaper_fns.SPI_CALIBRATION_FILE))
+
+
+if __name__ == '__main__':
+    main()